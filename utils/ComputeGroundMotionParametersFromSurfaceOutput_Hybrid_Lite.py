@@ -57,6 +57,7 @@ import time
 #import seissolxdmfwriter as sxw
 from scipy import signal
 from scipy.integrate import cumulative_trapezoid
+import gmProfiler
 
 #sys.path.append("%s/gmpe-smtk/" %(os.path.dirname(sys.argv[0])))
 try:
@@ -81,19 +82,262 @@ def low_pass_filter(waveform, fs, cutoff_freq):
     b,a = signal.butter(order, cutoff_freq, 'low', fs=fs)
     return signal.filtfilt(b, a, waveform)
 
+def blocks_of(n, size):
+    '''Yield slices that split range(n) into blocks of at most size'''
+    size = max(1, int(size))
+    for p in range(0, n, size):
+        yield slice(p, min(p+size, n))
+
+def rotation_matrices(angles):
+    """ cos and sin of the rotation angles (in degrees), as used by
+    smtk rotate_horizontal """
+    angles = np.asarray(angles, dtype=float) * (np.pi / 180.0)
+    return np.cos(angles), np.sin(angles)
+
+def gmrot_peaks(series_x, series_y, angles, max_elements=2**22):
+    """ peak absolute values of the rotated x and y series for all angles
+    series_x, series_y: (n_stations, n_columns, n_samples), time last
+    returns two (n_stations, n_angles, n_columns) arrays
+    The rotations are broadcast over an angle axis; stations and angles
+    are processed in blocks so that temporaries hold at most
+    max_elements values.
+    """
+    n_st, n_col, n_t = series_x.shape
+    cos_t, sin_t = rotation_matrices(angles)
+    max_x = np.zeros([n_st, len(angles), n_col], dtype=float)
+    max_y = np.zeros_like(max_x)
+    st_block = max(1, max_elements // (n_col * n_t))
+    for st in blocks_of(n_st, st_block):
+        x = series_x[st, np.newaxis]
+        y = series_y[st, np.newaxis]
+        n_block = x.shape[0] * n_col * n_t
+        for an in blocks_of(len(angles), max_elements // n_block):
+            c = cos_t[an, np.newaxis, np.newaxis]
+            s = sin_t[an, np.newaxis, np.newaxis]
+            rot_x = (c * x) + (s * y)
+            rot_y = (-s * x) + (c * y)
+            max_x[st, an] = np.max(np.fabs(rot_x), axis=-1)
+            max_y[st, an] = np.max(np.fabs(rot_y), axis=-1)
+    return max_x, max_y
+
+def cav_of(acceleration, time_step):
+    """ cumulative absolute velocity along the last axis, as smtk get_cav """
+    acceleration = np.fabs(acceleration)
+    return (time_step * (acceleration[..., 1:] + acceleration[..., :-1]) / 2.0).sum(axis=-1)
+
+def gmrot_cav(acceleration_x, time_step_x, acceleration_y, time_step_y, angles, max_elements=2**22):
+    """ geometric mean CAV of the rotated components for all angles
+    acceleration_x, acceleration_y: (n_stations, n_samples)
+    returns (n_stations, n_angles)
+    """
+    n_st, n_t = acceleration_x.shape
+    cos_t, sin_t = rotation_matrices(angles)
+    cav_theta = np.zeros([n_st, len(angles)], dtype=float)
+    for st in blocks_of(n_st, max(1, max_elements // n_t)):
+        x = acceleration_x[st, np.newaxis]
+        y = acceleration_y[st, np.newaxis]
+        for an in blocks_of(len(angles), max_elements // (x.shape[0] * n_t)):
+            c = cos_t[an, np.newaxis]
+            s = sin_t[an, np.newaxis]
+            rot_x = (c * x) + (s * y)
+            rot_y = (-s * x) + (c * y)
+            cav_theta[st, an] = np.sqrt(cav_of(rot_x, time_step_x) *
+                                        cav_of(rot_y, time_step_y))
+    return cav_theta
+
+accel_units_to_cm_s_s = {"g": 981., "m/s/s": 100., "cm/s/s": 1.}
+
+nigam_jennings_cache = {}
+
+def nigam_jennings_coefficients(time_step, periods, damping):
+    """ recurrence coefficients of the Nigam-Jennings (1969) piecewise
+    linear SDOF solution, cached per (time_step, periods, damping) """
+    periods = np.asarray(periods, dtype=float)
+    key = (float(time_step), periods.tobytes(), float(damping))
+    if key not in nigam_jennings_cache:
+        omega = (2. * np.pi) / periods
+        omega_d = omega * np.sqrt(1.0 - (damping ** 2.))
+        const = {'omega2': omega ** 2.,
+                 'f1': (2.0 * damping) / ((omega ** 3.) * time_step),
+                 'f2': 1.0 / (omega ** 2.),
+                 'f3': damping * omega,
+                 'f4': 1.0 / omega_d}
+        const['f5'] = const['f3'] * const['f4']
+        const['f6'] = 2.0 * const['f3']
+        e = np.exp(-const['f3'] * time_step)
+        s = np.sin(omega_d * time_step)
+        c = np.cos(omega_d * time_step)
+        const['g1'] = e * s
+        const['g2'] = e * c
+        const['h1'] = (omega_d * const['g2']) - (const['f3'] * const['g1'])
+        const['h2'] = (omega_d * const['g1']) + (const['f3'] * const['g2'])
+        nigam_jennings_cache[key] = const
+    return nigam_jennings_cache[key]
+
+def advance_nigam_jennings(acceleration, time_step, const, x_d, x_v):
+    """ advance the oscillator displacement and velocity states x_d, x_v
+    (n_stations, n_periods) over consecutive acceleration samples
+    (n_stations, n_samples); returns the absolute acceleration of the
+    oscillators at the n_samples-1 new steps, time first, and the new
+    states """
+    f1, f2, f4, f5, f6 = const['f1'], const['f2'], const['f4'], const['f5'], const['f6']
+    g1, g2, h1, h2 = const['g1'], const['g2'], const['h1'], const['h2']
+
+    n_st, n_t = acceleration.shape
+    x_a = np.zeros([n_t - 1, n_st, x_d.shape[1]], dtype=float)
+    for k in range(0, n_t - 1):
+        dug = (acceleration[:, k + 1] - acceleration[:, k])[:, np.newaxis]
+        z_1 = f2 * dug
+        z_2 = f2 * acceleration[:, k, np.newaxis]
+        z_3 = f1 * dug
+        z_4 = z_1 / time_step
+        b_val = x_d + z_2 - z_3
+        a_val = (f4 * x_v) + (f5 * b_val) + (f4 * z_4)
+        x_d = (a_val * g1) + (b_val * g2) + z_3 - z_2 - z_1
+        x_v = (a_val * h1) - (b_val * h2) - z_4
+        x_a[k] = (-f6 * x_v) - (const['omega2'] * x_d)
+    return x_a, x_d, x_v
+
+def get_response_spectrum_batch(acceleration, time_step, periods, damping=0.05, units="cm/s/s"):
+    """ Nigam-Jennings response of all oscillators of all stations
+    acceleration: (n_stations, n_samples)
+    returns the spectral accelerations (n_stations, n_periods) and the
+    absolute acceleration histories (n_stations, n_periods, n_samples-1),
+    matching smtk get_response_spectrum; a single time loop advances the
+    (n_stations, n_periods) oscillator state """
+    acceleration = np.atleast_2d(acceleration) * accel_units_to_cm_s_s[units]
+    const = nigam_jennings_coefficients(time_step, periods, damping)
+
+    n_st, n_t = acceleration.shape
+    x_v = np.zeros([n_st, len(periods)], dtype=float)
+    x_d = np.zeros_like(x_v)
+    x_a, _, _ = advance_nigam_jennings(acceleration, time_step, const, x_d, x_v)
+    x_a = np.moveaxis(x_a, 0, -1)
+    return np.max(np.fabs(x_a), axis=-1), x_a
+
+def running_cumulative_trapezoid(y, carry):
+    """ cumulative_trapezoid(y, initial=0.) continued from a previous
+    block; y holds the last sample of the previous block followed by the
+    new samples, carry is the running integral at that last sample.
+    The sums are accumulated in the same order as one call on the whole
+    series. """
+    increments = 1.0 * (y[:, 1:] + y[:, :-1]) / 2.0
+    return np.cumsum(np.column_stack((carry, increments)), axis=-1)[:, 1:]
+
+class gmrotdppAccumulator():
+    """
+    single pass, block by block counterpart of gmrotdpp_withPG_batch
+    Consecutive blocks of acceleration samples (n_stations, n_block) are
+    fed to update(); per angle peaks, CAV integrals, SDOF states and the
+    running velocity and displacement integrals are carried between
+    blocks, so memory depends on the block size and not on n_samples.
+    Peaks are identical to gmrotdpp_withPG_batch; CAV matches to rounding.
+    """
+    def __init__(self, n_st, n_t, time_step, periods, percentile,
+            damping=0.05, units="cm/s/s", angles=np.arange(0., 90., 1.), max_elements=2**22):
+        if (percentile > 100. + 1E-9) or (percentile < 0.):
+            raise ValueError("Percentile for GMRotDpp must be between 0. and 100.")
+        self.n_rows = n_t - 1 # samples entering the peak time series
+        self.time_step = time_step
+        self.percentile = percentile
+        self.units = units
+        self.angles = angles
+        self.max_elements = max_elements
+        self.const = nigam_jennings_coefficients(time_step, periods, damping)
+        self.n_samples_read = 0
+        self.n_rows_done = 0
+
+        n_col = len(periods) + 3
+        self.max_x = np.zeros([n_st, len(angles), n_col], dtype=float)
+        self.max_y = np.zeros_like(self.max_x)
+        self.cav_x = np.zeros([n_st, len(angles)], dtype=float)
+        self.cav_y = np.zeros_like(self.cav_x)
+        # per component: last acceleration sample, SDOF states, and the
+        # last row and running integral of the velocity and displacement
+        self.state = [{'last_acc': None,
+                       'x_d': np.zeros([n_st, len(periods)], dtype=float),
+                       'x_v': np.zeros([n_st, len(periods)], dtype=float),
+                       'last_acc_row': None, 'vel_sum': np.zeros(n_st),
+                       'last_vel_row': None, 'disp_sum': np.zeros(n_st)}
+                      for _ in range(2)]
+
+    def integrate_rows(self, rows, last_row, carry):
+        """ time_step * cumulative_trapezoid(initial=0.) of the new rows
+        continued from the previous block """
+        if last_row is None:
+            integral = np.zeros_like(rows)
+            integral[:, 1:] = running_cumulative_trapezoid(rows, carry)
+        else:
+            integral = running_cumulative_trapezoid(np.column_stack((last_row, rows)), carry)
+        return integral
+
+    def update(self, acceleration_x, acceleration_y):
+        n_block = acceleration_x.shape[1]
+        self.n_samples_read = self.n_samples_read + n_block
+        row_0 = self.n_rows_done
+        row_1 = min(self.n_samples_read - 1, self.n_rows)
+
+        series = []
+        extended = []
+        for state, acceleration in zip(self.state, (acceleration_x, acceleration_y)):
+            acceleration = acceleration * accel_units_to_cm_s_s[self.units]
+            if state['last_acc'] is None:
+                acc_ext = acceleration
+            else:
+                acc_ext = np.column_stack((state['last_acc'], acceleration))
+            state['last_acc'] = acceleration[:, -1]
+            extended.append(acc_ext)
+
+            with gmProfiler.stage('responseSpectrum'):
+                x_a, state['x_d'], state['x_v'] = advance_nigam_jennings(
+                    acc_ext, self.time_step, self.const, state['x_d'], state['x_v'])
+            if row_1 <= row_0:
+                continue
+
+            # acc_ext starts at sample row_0, as does x_a
+            acc_rows = acc_ext[:, :row_1 - row_0]
+            vel_sum = self.integrate_rows(acc_rows, state['last_acc_row'], state['vel_sum'])
+            velocity = self.time_step * vel_sum
+            disp_sum = self.integrate_rows(velocity, state['last_vel_row'], state['disp_sum'])
+            displacement = self.time_step * disp_sum
+            state['last_acc_row'], state['vel_sum'] = acc_rows[:, -1], vel_sum[:, -1]
+            state['last_vel_row'], state['disp_sum'] = velocity[:, -1], disp_sum[:, -1]
+
+            series.append(np.concatenate((acc_rows[:, np.newaxis], velocity[:, np.newaxis],
+                                          displacement[:, np.newaxis],
+                                          np.moveaxis(x_a[:row_1 - row_0], 0, -1)), axis=1))
+
+        if row_1 > row_0:
+            with gmProfiler.stage('rotationPercentile'):
+                max_x, max_y = gmrot_peaks(series[0], series[1], self.angles, self.max_elements)
+                np.maximum(self.max_x, max_x, out=self.max_x)
+                np.maximum(self.max_y, max_y, out=self.max_y)
+            self.n_rows_done = row_1
+
+        with gmProfiler.stage('cav'):
+            cos_t, sin_t = rotation_matrices(self.angles)
+            x, y = extended
+            for an in blocks_of(len(self.angles), self.max_elements // x.size):
+                c = cos_t[an, np.newaxis]
+                s = sin_t[an, np.newaxis]
+                self.cav_x[:, an] += cav_of((c * x[:, np.newaxis]) + (s * y[:, np.newaxis]), self.time_step)
+                self.cav_y[:, an] += cav_of((-s * x[:, np.newaxis]) + (c * y[:, np.newaxis]), self.time_step)
+
+    def result(self):
+        gmrotd = np.percentile(np.sqrt(self.max_x * self.max_y), self.percentile, axis=1)
+        cav_theta = np.sqrt(self.cav_x * self.cav_y)
+        res =  {"PGA": gmrotd[:, 0],
+                "PGV": gmrotd[:, 1],
+                "PGD": gmrotd[:, 2],
+                "Acceleration": gmrotd[:, 3:],
+                "CAV": np.percentile(cav_theta, self.percentile, axis=1)}
+        return res
+
 def compute_cav_gmrot(acceleration_x, time_step_x, acceleration_y, time_step_y, angles, percentile):
     """ compute the cumulative velocity using gmrot """
-    from smtk.intensity_measures import get_cav, rotate_horizontal
-    cav_theta = np.zeros(len(angles), dtype=float)
-    for iloc, theta in enumerate(angles):
-        if iloc == 0:
-            cav_theta[iloc] = np.sqrt(get_cav(acceleration_x, time_step_x) * 
-                    get_cav(acceleration_y, time_step_y))
-        else:
-            rot_x, rot_y = rotate_horizontal(acceleration_x, acceleration_y, theta)
-            cav_theta[iloc] = np.sqrt(get_cav(rot_x, time_step_x) * 
-                    get_cav(rot_y, time_step_y))
-    return np.percentile(cav_theta, percentile)
+    cav_theta = gmrot_cav(np.atleast_2d(acceleration_x), time_step_x,
+                          np.atleast_2d(acceleration_y), time_step_y, angles)
+    return np.percentile(cav_theta[0], percentile)
 
 def gmrotdpp_withPG(acceleration_x, time_step_x, acceleration_y, time_step_y, periods,
         percentile, damping=0.05, units="cm/s/s", method="Nigam-Jennings"):
@@ -101,18 +345,19 @@ def gmrotdpp_withPG(acceleration_x, time_step_x, acceleration_y, time_step_y, pe
     modified from gmrotdpp to also return gmrotdpp(PGA, PGV and PGD)
     This is much faster than gmrotdpp_slow
     """
-    from smtk.intensity_measures import get_response_spectrum,equalise_series,rotate_horizontal
+    from smtk.intensity_measures import get_response_spectrum,equalise_series
     if (percentile > 100. + 1E-9) or (percentile < 0.):
         raise ValueError("Percentile for GMRotDpp must be between 0. and 100.")
     # Get the time-series corresponding to the SDOF
-    sax, _, x_a, _, _ = get_response_spectrum(acceleration_x,
-                                              time_step_x,
-                                              periods, damping,
-                                              units, method)
-    say, _, y_a, _, _ = get_response_spectrum(acceleration_y,
-                                              time_step_y,
-                                              periods, damping,
-                                              units, method)
+    with gmProfiler.stage('responseSpectrum'):
+        sax, _, x_a, _, _ = get_response_spectrum(acceleration_x,
+                                                  time_step_x,
+                                                  periods, damping,
+                                                  units, method)
+        say, _, y_a, _, _ = get_response_spectrum(acceleration_y,
+                                                  time_step_y,
+                                                  periods, damping,
+                                                  units, method)
     x_a, y_a = equalise_series(x_a, y_a)
 
     #TU: this is the part I m adding
@@ -127,19 +372,11 @@ def gmrotdpp_withPG(acceleration_x, time_step_x, acceleration_y, time_step_y, pe
     y_a = np.column_stack((acceleration_y[0:-1], velocity_y, displacement_y, y_a))
 
     angles = np.arange(0., 90., 1.)
-    max_a_theta = np.zeros([len(angles), len(periods)+3], dtype=float)
-    max_a_theta[0, :] = np.sqrt(np.max(np.fabs(x_a), axis=0) *
-                                np.max(np.fabs(y_a), axis=0))
-    for iloc, theta in enumerate(angles):
-        if iloc == 0:
-            max_a_theta[iloc, :] = np.sqrt(np.max(np.fabs(x_a), axis=0) *
-                                           np.max(np.fabs(y_a), axis=0))
-        else:
-            rot_x, rot_y = rotate_horizontal(x_a, y_a, theta)
-            max_a_theta[iloc, :] = np.sqrt(np.max(np.fabs(rot_x), axis=0) *
-                                           np.max(np.fabs(rot_y), axis=0))
+    with gmProfiler.stage('rotationPercentile'):
+        max_x, max_y = gmrot_peaks(x_a.T[np.newaxis], y_a.T[np.newaxis], angles)
+        max_a_theta = np.sqrt(max_x[0] * max_y[0])
 
-    gmrotd = np.percentile(max_a_theta, percentile, axis=0)
+        gmrotd = np.percentile(max_a_theta, percentile, axis=0)
 
     res =  {"PGA": gmrotd[0],
             "PGV": gmrotd[1],
@@ -147,8 +384,77 @@ def gmrotdpp_withPG(acceleration_x, time_step_x, acceleration_y, time_step_y, pe
             "Acceleration": gmrotd[3:]}
 
     #if args.CAV:
-    cav = compute_cav_gmrot(acceleration_x, time_step_x, acceleration_y, time_step_y, angles, percentile)
+    with gmProfiler.stage('cav'):
+        cav = compute_cav_gmrot(acceleration_x, time_step_x, acceleration_y, time_step_y, angles, percentile)
     res['CAV']=cav
 
     return res
 
+def gmrotdpp_withPG_batch(acceleration_x, time_step, acceleration_y, periods,
+        percentile, damping=0.05, units="cm/s/s", method="Nigam-Jennings", max_elements=2**22):
+    """
+    gmrotdpp_withPG for a batch of stations
+    acceleration_x, acceleration_y: (n_stations, n_samples)
+    returns the same keys as gmrotdpp_withPG with one value (or one row of
+    spectral accelerations) per station
+    Stations are processed in blocks whose (n_block, n_periods+3, n_samples)
+    series hold at most max_elements values, so memory does not grow with
+    the batch size and stays proportional to max_elements for long records.
+    """
+    if (percentile > 100. + 1E-9) or (percentile < 0.):
+        raise ValueError("Percentile for GMRotDpp must be between 0. and 100.")
+    n_st, n_t = acceleration_x.shape
+    st_block = max(1, max_elements // ((len(periods) + 3) * n_t))
+    if n_st <= st_block:
+        return gmrotdpp_withPG_block(acceleration_x, time_step, acceleration_y, periods,
+                                     percentile, damping, units, method)
+    res = {}
+    for st in blocks_of(n_st, st_block):
+        res_block = gmrotdpp_withPG_block(acceleration_x[st], time_step, acceleration_y[st], periods,
+                                          percentile, damping, units, method)
+        for key, value in res_block.items():
+            res.setdefault(key, []).append(value)
+    return {key: np.concatenate(values) for key, values in res.items()}
+
+def gmrotdpp_withPG_block(acceleration_x, time_step, acceleration_y, periods,
+        percentile, damping, units, method):
+    """ gmrotdpp_withPG_batch for one block of stations """
+    n_st, n_t = acceleration_x.shape
+    # columns are acceleration, velocity, displacement and the SDOF
+    # acceleration for every period; time is the last axis
+    x_a = np.zeros([n_st, len(periods)+3, n_t-1], dtype=float)
+    y_a = np.zeros_like(x_a)
+    for x_y_a, acceleration in ((x_a, acceleration_x), (y_a, acceleration_y)):
+        with gmProfiler.stage('responseSpectrum'):
+            if method == "Nigam-Jennings":
+                _, x_y_a[:, 3:] = get_response_spectrum_batch(acceleration, time_step,
+                                                              periods, damping, units)
+            else:
+                from smtk.intensity_measures import get_response_spectrum
+                for ist in range(n_st):
+                    _, _, sdof_a, _, _ = get_response_spectrum(acceleration[ist],
+                                                               time_step,
+                                                               periods, damping,
+                                                               units, method)
+                    x_y_a[ist, 3:] = sdof_a.T
+        velocity = time_step * cumulative_trapezoid(acceleration[:, 0:-1], initial=0., axis=-1)
+        displacement = time_step * cumulative_trapezoid(velocity, initial=0., axis=-1)
+        x_y_a[:, 0] = acceleration[:, 0:-1]
+        x_y_a[:, 1] = velocity
+        x_y_a[:, 2] = displacement
+
+    angles = np.arange(0., 90., 1.)
+    with gmProfiler.stage('rotationPercentile'):
+        max_x, max_y = gmrot_peaks(x_a, y_a, angles)
+        gmrotd = np.percentile(np.sqrt(max_x * max_y), percentile, axis=1)
+
+    with gmProfiler.stage('cav'):
+        cav_theta = gmrot_cav(acceleration_x, time_step, acceleration_y, time_step, angles)
+        cav = np.percentile(cav_theta, percentile, axis=1)
+
+    res =  {"PGA": gmrotd[:, 0],
+            "PGV": gmrotd[:, 1],
+            "PGD": gmrotd[:, 2],
+            "Acceleration": gmrotd[:, 3:],
+            "CAV": cav}
+    return res
@@ -1,8 +1,12 @@
 #! /usr/bin/env python3
 import numpy as np
-import os, sys
+import os, sys, hashlib
 import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
+import scipy.sparse
+from gmStoreLib import gmStore, findChunkIds
+from scipy.spatial import Delaunay
 
 class genMapsForEQDYNA:
     def __init__(self, mapType='gm', timeInSec=5, gmComp='strike', cmap='plasma', dim=2):    
@@ -13,8 +17,12 @@ class genMapsForEQDYNA:
         self.T = par.term
         self.dtype = np.float64
         self.valueSize = np.dtype(self.dtype).itemsize
-        self.timeStepId = round(timeInSec/self.dt)
-        self.timeInSec = timeInSec
+        # timeInSec is one time or a list/range of times; all of them are
+        # extracted in one pass by genMap
+        self.timesInSec = list(np.atleast_1d(timeInSec))
+        self.timeStepIds = [round(t/self.dt) for t in self.timesInSec]
+        self.timeStepId = self.timeStepIds[0]
+        self.timeInSec = self.timesInSec[0]
 
         self.mapType = mapType
         self.cmap = cmap
@@ -45,7 +53,7 @@ class genMapsForEQDYNA:
             self.nValue = [1]
             self.xAxisId = 0
             self.yAxisId = 2
-            self.varLegend = ['Slip rate (m/s)']
+            self.varLegend = 'Slip rate (m/s)'
             self.titlePrefix = 'Source at '
         elif self.mapType == 'gm+src':
             if self.dim !=3:
@@ -72,49 +80,122 @@ class genMapsForEQDYNA:
             sys.exit(1)
 
     def genMap(self):
-        nTag = 0
+        # Reads every requested time step of every chunk as contiguous
+        # slices of a memory-mapped data file. self.frames holds one row of
+        # values per time and self.fullMap the coordinates (km) plus the
+        # values of the first time. Archived runs without gm files are read
+        # from the gm store.
+        chunks = []
+        store = None
         for iMapType, mapType in enumerate(self.mapTypeToProcess):
-            for chunkId in range(1000):
-                dataFileName = self.dataFileNamePrefix[iMapType] + str(chunkId)
+            chunkIds = findChunkIds(self.dataFileNamePrefix[iMapType])
+            if mapType == 'gm' and len(chunkIds) == 0 and gmStore.exists():
+                store = gmStore()
+                for chunkId in store.getChunkIds():
+                    chunks.append((iMapType, chunkId, store.loadStLoc(chunkId)))
+                continue
+            for chunkId in chunkIds:
                 stLocFileName = self.stLocFileNamePrefix[iMapType] + str(chunkId)
-                if os.path.isfile(dataFileName):
-                    stLoc = np.loadtxt(stLocFileName)
-                    numOfSt = stLoc.shape[0]
-                    map = np.zeros((stLoc.shape[0],4))
-                    map[:,:3] = stLoc[:,:3]
-                    startIndex = self.timeStepId*numOfSt*self.nValue[iMapType]
-                    
-                    with open(dataFileName, 'rb') as f:
-                        for i in range(numOfSt):
-                            index = startIndex + i*self.nValue[iMapType]
-                            f.seek(index*self.valueSize)
-                            values = np.fromfile(f, dtype=self.dtype, count=self.nValue[iMapType]) 
-                            if mapType == 'gm':
-                                map[i,3] = values[self.gmCompId]
-                            else:
-                                map[i,3] = values
-
-                    if nTag==0: 
-                        self.fullMap = map
-                    else:
-                        self.fullMap = np.vstack((self.fullMap, map))
-                    nTag += 1
+                stLoc = np.loadtxt(stLocFileName, ndmin=2)
+                chunks.append((iMapType, chunkId, stLoc))
+
+        numOfStTotal = sum(stLoc.shape[0] for _, _, stLoc in chunks)
+        self.fullMap = np.zeros((numOfStTotal,4))
+        self.frames = np.zeros((len(self.timeStepIds), numOfStTotal))
+
+        start = 0
+        for iMapType, chunkId, stLoc in chunks:
+            dataFileName = self.dataFileNamePrefix[iMapType] + str(chunkId)
+            numOfSt = stLoc.shape[0]
+            nValue = self.nValue[iMapType]
+            compId = self.gmCompId if self.mapTypeToProcess[iMapType] == 'gm' else 0
+            if store is not None and self.mapTypeToProcess[iMapType] == 'gm':
+                if max(self.timeStepIds) >= store.numOfTimeStep:
+                    sys.exit(store.path+' has '+str(store.numOfTimeStep)+' time steps; requested time is out of range.')
+                self.fullMap[start:start+numOfSt,:3] = stLoc[:,:3]
+                self.frames[:,start:start+numOfSt] = store.getTimeSlices(chunkId, self.timeStepIds, compId)
+                start = start + numOfSt
+                continue
+
+            numOfTimeStep = os.path.getsize(dataFileName)//self.valueSize//(numOfSt*nValue)
+            if max(self.timeStepIds) >= numOfTimeStep:
+                sys.exit(dataFileName+' has '+str(numOfTimeStep)+' time steps; requested time is out of range.')
+
+            data = np.memmap(dataFileName, dtype=self.dtype, mode='r', shape=(numOfTimeStep, numOfSt, nValue))
+            self.fullMap[start:start+numOfSt,:3] = stLoc[:,:3]
+            self.frames[:,start:start+numOfSt] = data[self.timeStepIds, :, compId]
+            start = start + numOfSt
+
         self.fullMap[:,:3] = self.fullMap[:,:3]/1e3
+        self.setFrame(0)
         return self.fullMap
+
+    def setFrame(self, iFrame):
+        # Selects the time whose values are saved and plotted.
+        self.timeStepId = self.timeStepIds[iFrame]
+        self.timeInSec = self.timesInSec[iFrame]
+        self.fullMap[:,3] = self.frames[iFrame]
     
     def saveMap(self):
         np.savetxt(self.mapType+str(self.timeInSec)+'.txt', np.vstack(self.fullMap), delimiter='\t', fmt='%.6f')
     
+    def getInterpolationWeights(self, xi, yi):
+        # Sparse (xi.size x numOfSt) matrix of the linear barycentric weights
+        # that griddata(..., method='linear') uses, built from one Delaunay
+        # triangulation of the station coordinates. The matrix only depends
+        # on the geometry and the target mesh, so it is kept in memory and
+        # cached on disk in gMapWeights_<hash>.npz.
+        points = np.ascontiguousarray(self.fullMap[:,[self.xAxisId, self.yAxisId]])
+        h = hashlib.sha1()
+        for a in (points, xi, yi):
+            h.update(np.ascontiguousarray(a, dtype=np.float64).tobytes())
+        key = h.hexdigest()[:16]
+        if getattr(self, 'weightsKey', None) == key:
+            return self.weights
+
+        fileName = 'gMapWeights_'+key+'.npz'
+        if os.path.isfile(fileName):
+            weights = scipy.sparse.load_npz(fileName)
+        else:
+            tri = Delaunay(points)
+            targets = np.column_stack((xi.ravel(), yi.ravel()))
+            simplex = tri.find_simplex(targets)
+            inside = np.nonzero(simplex >= 0)[0]
+            transform = tri.transform[simplex[inside]]
+            bary = np.einsum('ijk,ik->ij', transform[:,:2,:], targets[inside]-transform[:,2,:])
+            c = np.column_stack((bary, 1.0-bary[:,0]-bary[:,1]))
+            rows = np.repeat(inside, 3)
+            cols = tri.simplices[simplex[inside]].ravel()
+            weights = scipy.sparse.csr_matrix((c.ravel(), (rows, cols)), shape=(targets.shape[0], points.shape[0]))
+            scipy.sparse.save_npz(fileName, weights)
+
+        self.weightsKey = key
+        self.weights = weights
+        return weights
+
+    def interpolateOnMesh(self, xi, yi):
+        # Linear interpolation of the current values onto the mesh; points
+        # outside the convex hull of the stations are NaN, as in griddata.
+        weights = self.getInterpolationWeights(xi, yi)
+        values = weights @ self.fullMap[:,3]
+        values[np.diff(weights.indptr) == 0] = np.nan
+        return values.reshape(xi.shape)
+
+    def getMesh(self):
+        # Regular mesh (km) covering the stations with the model spacing.
+        mapXmin, mapXmax = self.fullMap[:,self.xAxisId].min(), self.fullMap[:,self.xAxisId].max()
+        mapYmin, mapYmax = self.fullMap[:,self.yAxisId].min(), self.fullMap[:,self.yAxisId].max()
+        nx = round((mapXmax - mapXmin)/self.dx)
+        ny = round((mapYmax - mapYmin)/self.dy)
+        xi = np.linspace(mapXmin, mapXmax, num=nx)
+        yi = np.linspace(mapYmin, mapYmax, num=ny)
+        return np.meshgrid(xi, yi)
+
     def plotMap(self):
+        self.fig.clf()
         if self.dim == 2: 
-            mapXmin, mapXmax = self.fullMap[:,self.xAxisId].min(), self.fullMap[:,self.xAxisId].max()
-            mapYmin, mapYmax = self.fullMap[:,self.yAxisId].min(), self.fullMap[:,self.yAxisId].max()
-            nx = round((mapXmax - mapXmin)/self.dx)
-            ny = round((mapYmax - mapYmin)/self.dy)
-            xi = np.linspace(mapXmin, mapXmax, num=nx)
-            yi = np.linspace(mapYmin, mapYmax, num=ny)
-            xi, yi = np.meshgrid(xi, yi) 
-            values = griddata((self.fullMap[:,self.xAxisId], self.fullMap[:,self.yAxisId]), self.fullMap[:,3], (xi, yi), method='linear')
+            xi, yi = self.getMesh()
+            values = self.interpolateOnMesh(xi, yi)
                     
             ax = self.fig.add_subplot()
             plt.pcolormesh(xi, yi, values, cmap=self.cmap)
@@ -142,6 +223,66 @@ class genMapsForEQDYNA:
             #plt.show()
             plt.savefig(f'gMap'+self.titlePrefix+'-t='+str(self.timeInSec)+'-s.png', dpi=300)
 
-        
+    def genMovie(self, numOfWorkers=1, cbMin=None, cbMax=None):
+        # Renders every frame extracted by genMap as gMovie-<mapType>-<nnnn>.png
+        # with one fixed colorbar range, so the frames can be joined into a
+        # movie. For 2-D maps the gridded frames are also stacked into
+        # gMovie-<mapType>.npy (nFrames, ny, nx; float32, NaN outside the
+        # stations) with the mesh and times in gMovie-<mapType>-mesh.npz.
+        if cbMin is not None: self.cbMin = cbMin
+        if cbMax is not None: self.cbMax = cbMax
+        prefix = 'gMovie-'+self.mapType.replace('+','-')
 
+        frameArgs = []
+        if self.dim == 2:
+            xi, yi = self.getMesh()
+            weights = self.getInterpolationWeights(xi, yi)
+            gridded = np.asarray(weights @ self.frames.T, dtype=np.float32)
+            gridded[np.diff(weights.indptr) == 0, :] = np.nan
+            gridded = np.ascontiguousarray(gridded.T).reshape((len(self.timesInSec),)+xi.shape)
+            np.save(prefix+'.npy', gridded)
+            np.savez(prefix+'-mesh.npz', xi=xi, yi=yi, timesInSec=np.asarray(self.timesInSec))
+            for iFrame, t in enumerate(self.timesInSec):
+                frameArgs.append(dict(dim=2, coor=(xi, yi), values=gridded[iFrame]))
+        else:
+            coor = (self.fullMap[:,0], self.fullMap[:,1], self.fullMap[:,2])
+            for iFrame, t in enumerate(self.timesInSec):
+                frameArgs.append(dict(dim=3, coor=coor, values=self.frames[iFrame], alpha=self.alpha))
+
+        for iFrame, t in enumerate(self.timesInSec):
+            frameArgs[iFrame].update(cmap=self.cmap, cbMin=self.cbMin, cbMax=self.cbMax, label=self.varLegend,
+                                     title=self.titlePrefix+' t='+'%.3f'%t+' s',
+                                     fileName=prefix+'-%04d.png'%iFrame)
+
+        if numOfWorkers > 1:
+            with ProcessPoolExecutor(max_workers=numOfWorkers) as executor:
+                fileNames = list(executor.map(renderMovieFrame, frameArgs, chunksize=max(1, len(frameArgs)//(4*numOfWorkers))))
+        else:
+            fileNames = list(map(renderMovieFrame, frameArgs))
+        print(str(len(fileNames))+' frames are written to '+prefix+'-*.png')
+        return fileNames
 
+def renderMovieFrame(frame):
+    # Draws one movie frame on its own Agg figure; it does not touch the
+    # pyplot state, so frames can be rendered in worker processes.
+    fig = Figure(figsize=(8,8))
+    if frame['dim'] == 2:
+        xi, yi = frame['coor']
+        ax = fig.add_subplot()
+        mesh = ax.pcolormesh(xi, yi, frame['values'], cmap=frame['cmap'], vmin=frame['cbMin'], vmax=frame['cbMax'])
+        fig.colorbar(mesh, ax=ax, label=frame['label'])
+        ax.set_xlabel('Along-strike (km)', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Fault-normal (km)', fontsize=12, fontweight='bold')
+    else:
+        x, y, z = frame['coor']
+        ax = fig.add_subplot(111, projection='3d')
+        sc = ax.scatter(x, y, z, c=frame['values'], cmap=frame['cmap'], vmin=frame['cbMin'], vmax=frame['cbMax'], alpha=frame['alpha'])
+        fig.colorbar(sc, ax=ax, label=frame['label'], orientation='horizontal', fraction=0.02, pad=0.1)
+        ax.set_xlabel('Along-strike (km)', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Fault-normal (km)', fontsize=12, fontweight='bold')
+        ax.set_zlabel('Up (km)', fontsize=12, fontweight='bold')
+        ax.view_init(elev=-15, azim=-150)
+    ax.axis('equal')
+    ax.set_title(frame['title'], fontsize=12, fontweight='bold')
+    fig.savefig(frame['fileName'], dpi=150)
+    return frame['fileName']
@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+# Source-to-site distances Rjb, Rrup and Rx of whole sets of stations.
+# Faults are described by
+#   'strike' a vertical, surface-rupturing fault along y=0 between
+#            faultXmin and faultXmax (analytic, as the original calcRjb),
+#   'trace'  a vertical, surface-rupturing fault along the polyline
+#            faultTrace, an (n, 2) array of x, y,
+#   'mesh'   the fault nodes of the frt.txt<N> files, e.g. rough or dipping
+#            faults.
+# Rx is the horizontal distance from the fault trace measured normal to the
+# local strike, positive to the right of the strike direction.
+import os, hashlib
+import numpy as np
+from scipy.spatial import cKDTree, ConvexHull, QhullError
+
+def calcDistancesStrike(stLocs, faultXmin, faultXmax):
+    x = stLocs[:,0]
+    y = stLocs[:,1]
+    Rjb = np.where(x <= faultXmin, ((x-faultXmin)**2 + y**2)**0.5,
+                   np.where(x >= faultXmax, ((x-faultXmax)**2 + y**2)**0.5, np.abs(y)))
+    return {'Rjb': Rjb, 'Rrup': Rjb.copy(), 'Rx': -y.astype(np.float64)}
+
+def getNearestSegmentsExhaustive(points, a, d, len2, maxElements=2**22):
+    # Index of, and distance to, the nearest of all segments a + t*d,
+    # 0 <= t <= 1, broadcasting over blocks of points.
+    iSeg = np.zeros(points.shape[0], dtype=np.int64)
+    dist = np.zeros(points.shape[0])
+    blockSize = max(1, maxElements//a.shape[0])
+    for start in range(0, points.shape[0], blockSize):
+        pa = points[start:start+blockSize, np.newaxis, :] - a
+        t = np.clip(np.sum(pa*d, axis=-1)/len2, 0., 1.)
+        r = pa - t[..., np.newaxis]*d
+        distToSegs = np.hypot(r[..., 0], r[..., 1])
+        iSeg[start:start+blockSize] = np.argmin(distToSegs, axis=1)
+        dist[start:start+blockSize] = distToSegs[np.arange(distToSegs.shape[0]), iSeg[start:start+blockSize]]
+    return iSeg, dist
+
+def getNearestSegments(points, trace, numOfCandidates=8):
+    # Index of, and distance to, the nearest segment of the polyline trace
+    # for every point. Long (rough) traces only test the two segments next
+    # to each of the numOfCandidates nearest vertices of a KD-tree. The
+    # result is exact: a segment closer than the best one found has a
+    # vertex within (dist**2 + maxSegLength**2/4)**0.5, so points for which
+    # that radius reaches the farthest candidate are searched exhaustively.
+    a = trace[:-1]
+    d = trace[1:] - trace[:-1]
+    len2 = np.maximum(np.sum(d**2, axis=1), np.finfo(float).tiny)
+    numOfSeg = a.shape[0]
+    if numOfSeg <= 4*numOfCandidates:
+        return getNearestSegmentsExhaustive(points, a, d, len2)
+
+    distToVertices, vertices = cKDTree(trace, leafsize=64).query(points, k=numOfCandidates)
+    iSeg = np.zeros(points.shape[0], dtype=np.int64)
+    dist = np.zeros(points.shape[0])
+    blockSize = 2**22//(2*numOfCandidates)
+    for start in range(0, points.shape[0], blockSize):
+        p = points[start:start+blockSize]
+        v = vertices[start:start+blockSize]
+        segs = np.clip(np.concatenate((v-1, v), axis=1), 0, numOfSeg-1)
+        pa = p[:, np.newaxis, :] - a[segs]
+        t = np.clip(np.sum(pa*d[segs], axis=-1)/len2[segs], 0., 1.)
+        r = pa - t[..., np.newaxis]*d[segs]
+        distToSegs = np.hypot(r[..., 0], r[..., 1])
+        nearest = np.argmin(distToSegs, axis=1)
+        rows = np.arange(p.shape[0])
+        iSeg[start:start+blockSize] = segs[rows, nearest]
+        dist[start:start+blockSize] = distToSegs[rows, nearest]
+
+    unresolved = np.nonzero(dist**2 + len2.max()/4 >= distToVertices[:, -1]**2)[0]
+    if len(unresolved) > 0:
+        iSeg[unresolved], dist[unresolved] = getNearestSegmentsExhaustive(points[unresolved], a, d, len2)
+    return iSeg, dist
+
+def calcRxToTrace(points, trace, iSeg):
+    a = trace[iSeg]
+    d = trace[iSeg+1] - a
+    cross = d[:,0]*(points[:,1]-a[:,1]) - d[:,1]*(points[:,0]-a[:,0])
+    return -cross/np.maximum(np.hypot(d[:,0], d[:,1]), np.finfo(float).tiny)
+
+def calcDistancesToTrace(stLocs, trace):
+    # Vertical fault reaching the surface along trace; stations are on the
+    # surface, so Rrup equals Rjb.
+    trace = np.asarray(trace, dtype=np.float64)
+    iSeg, Rjb = getNearestSegments(stLocs[:,:2], trace)
+    return {'Rjb': Rjb, 'Rrup': Rjb.copy(), 'Rx': calcRxToTrace(stLocs[:,:2], trace, iSeg)}
+
+def getTopEdge(faultNodes, spacing):
+    # Top row of fault nodes ordered along strike, used as the fault trace.
+    # The strike is oriented so that a dipping fault dips to its right, i.e.
+    # Rx is positive on the hanging wall, and along +x for vertical faults.
+    top = faultNodes[faultNodes[:, 2] >= faultNodes[:, 2].max()-spacing/2]
+    centre = top[:, :2].mean(axis=0)
+    strike = np.linalg.svd(top[:, :2]-centre, full_matrices=False)[2][0]
+    offset = faultNodes[:, :2].mean(axis=0) - centre
+    dipSide = strike[0]*offset[1] - strike[1]*offset[0]
+    if abs(dipSide) > spacing/2:
+        if dipSide > 0:
+            strike = -strike
+    elif strike[0] < 0 or (strike[0] == 0 and strike[1] < 0):
+        strike = -strike
+    return top[np.argsort((top[:, :2]-centre) @ strike)]
+
+def getFootprint(projected, spacing):
+    # Convex hull of the surface projection of the fault, or None if the
+    # projection is (nearly) a line, as for vertical faults.
+    try:
+        hull = ConvexHull(projected)
+    except QhullError:
+        return None
+    # in 2-D, volume is the area and area the perimeter of the hull
+    if 2*hull.volume/hull.area < spacing:
+        return None
+    return hull
+
+def calcDistancesToMesh(stLocs, faultNodes):
+    # Rrup and Rjb are distances to the nearest fault node and to the
+    # nearest surface projection of a node, bounded by the exact distances
+    # to the top edge of the mesh. They are exact for vertical faults and
+    # within half the node spacing otherwise. Rjb is zero inside the
+    # projected rupture, taken as the part of the convex hull of the
+    # projected nodes that is within one node spacing of a node. Rx uses
+    # the top edge as the fault trace.
+    tree = cKDTree(faultNodes, leafsize=64)
+    spacing = float(np.median(tree.query(faultNodes, k=2)[0][:, 1]))
+    Rrup = tree.query(stLocs)[0]
+
+    projected = np.unique(faultNodes[:, :2], axis=0)
+    Rjb = cKDTree(projected, leafsize=64).query(stLocs[:, :2])[0]
+
+    topEdge = getTopEdge(faultNodes, spacing)
+    if topEdge.shape[0] >= 2:
+        trace = topEdge[:, :2]
+        iSeg, distToTrace = getNearestSegments(stLocs[:, :2], trace)
+        Rjb = np.minimum(Rjb, distToTrace)
+        depthOfTop = np.maximum(stLocs[:, 2]-topEdge[:, 2].max(), 0.)
+        Rrup = np.minimum(Rrup, np.hypot(distToTrace, depthOfTop))
+        Rx = calcRxToTrace(stLocs[:, :2], trace, iSeg)
+    else:
+        Rx = np.zeros(stLocs.shape[0])
+
+    footprint = getFootprint(projected, spacing)
+    if footprint is not None:
+        equations = footprint.equations
+        inside = np.all(stLocs[:, :2] @ equations[:, :2].T + equations[:, 2] <= spacing*1e-6, axis=1)
+        Rjb[inside & (Rjb <= spacing)] = 0.
+    return {'Rjb': Rjb, 'Rrup': Rrup, 'Rx': Rx}
+
+def findFaultMeshFiles(fileNamePrefix):
+    fileNames = [fName for fName in os.listdir('.') if fName.startswith(fileNamePrefix) and fName[len(fileNamePrefix):].isdigit()]
+    return sorted(fileNames, key=lambda fName: int(fName[len(fileNamePrefix):]))
+
+def loadFaultMesh(fileNamePrefix='frt.txt'):
+    fileNames = findFaultMeshFiles(fileNamePrefix)
+    if len(fileNames) == 0:
+        raise FileNotFoundError('no '+fileNamePrefix+'<N> files are found for the fault mesh')
+    return np.unique(np.vstack([np.loadtxt(fName, ndmin=2)[:,:3] for fName in fileNames]), axis=0)
+
+def getDistancesCacheKey(stLocs, par):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(stLocs, dtype=np.float64).tobytes())
+    h.update(par.faultType.encode())
+    if par.faultType == 'strike':
+        h.update(repr((float(par.faultXmin), float(par.faultXmax))).encode())
+    elif par.faultType == 'trace':
+        h.update(np.ascontiguousarray(par.faultTrace, dtype=np.float64).tobytes())
+    elif par.faultType == 'mesh':
+        for fName in findFaultMeshFiles(par.faultMeshPrefix):
+            fileStat = os.stat(fName)
+            h.update(repr((fName, fileStat.st_size, fileStat.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+def calcDistances(stLocs, par):
+    if par.faultType == 'strike':
+        return calcDistancesStrike(stLocs, par.faultXmin, par.faultXmax)
+    elif par.faultType == 'trace':
+        return calcDistancesToTrace(stLocs, par.faultTrace)
+    elif par.faultType == 'mesh':
+        return calcDistancesToMesh(stLocs, loadFaultMesh(par.faultMeshPrefix))
+    raise ValueError('Unknown faultType '+str(par.faultType)+'; use strike, trace or mesh')
+
+def getDistances(stLocs, par, useCache=True):
+    # Rjb, Rrup and Rx of every station, cached in gmDistances_<hash>.npz
+    # per set of stations and fault geometry.
+    stLocs = np.atleast_2d(np.asarray(stLocs, dtype=np.float64))
+    fileName = 'gmDistances_'+getDistancesCacheKey(stLocs, par)+'.npz'
+    if useCache and os.path.isfile(fileName):
+        with np.load(fileName) as distances:
+            return {key: distances[key] for key in distances.files}
+    distances = calcDistances(stLocs, par)
+    if useCache:
+        np.savez(fileName, **distances)
+    return distances
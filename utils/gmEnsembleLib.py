@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+# Catalog of an ensemble of runs for gmEnsemble. A run is a directory with
+# gm data (gm<N> and surface_coor.txt<N> files or a gmStore), either
+# directly or in the gmData folder of archiveGMData, and usually a
+# modelMetadata.txt written by metadataWriter. The catalog gmCatalog.json at
+# the root of the ensemble lists every run with its metadata and status and
+# indexes the runs by metadata key and value. Processed maps of a run are
+# consolidated with the map settings and a fingerprint of its gm data in
+# gmRunResults.npz in the run directory, so finished runs are recognized and
+# cross-run queries read one file per run.
+import os, json, time
+import numpy as np
+from metadataDict import sourceElements, pathElements, siteElements, code, codeVersion
+
+catalogFileName = 'gmCatalog.json'
+resultsFileName = 'gmRunResults.npz'
+metadataFileName = 'modelMetadata.txt'
+catalogVersion = 1
+
+def parseModelMetadata(fileName):
+    # modelMetadata.txt holds lines like %faultGeometry:planar%frictionLaw:rsfs
+    # appended by metadataWriter; the last one describes the run.
+    lines = []
+    with open(fileName, 'r') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    metadata = {}
+    if len(lines) > 0:
+        for item in lines[-1].split('%'):
+            if ':' in item:
+                key, value = item.split(':', 1)
+                metadata[key.strip()] = value.strip()
+    return metadata
+
+def checkMetadata(metadata):
+    # Returns the key:value pairs whose key is not in metadataDict or whose
+    # value is not one of the options of its key.
+    options = {}
+    for dictName in [sourceElements, pathElements, siteElements, code, codeVersion]:
+        options.update(dictName)
+    return [key+':'+value for key, value in metadata.items() if key not in options or value not in options[key]]
+
+def hasGMData(path):
+    fileNames = os.listdir(path)
+    if os.path.isfile(os.path.join(path, 'gmStore', 'meta.json')):
+        return True
+    return any(fileName.startswith('gm') and fileName[2:].isdigit() for fileName in fileNames) \
+        and any(fileName.startswith('surface_coor.txt') for fileName in fileNames)
+
+def getDataPath(runPath):
+    # Directory gmProcessor runs in: the run itself or its gmData folder.
+    for path in [runPath, os.path.join(runPath, 'gmData')]:
+        if os.path.isdir(path) and hasGMData(path):
+            return path
+    return None
+
+def getDataFingerprint(dataPath):
+    # Names, sizes and mtimes of the gm data, so results are recomputed when
+    # a run is rewritten.
+    fingerprint = []
+    for fileName in sorted(os.listdir(dataPath)):
+        if (fileName.startswith('gm') and fileName[2:].isdigit()) or fileName.startswith('surface_coor.txt'):
+            fileStat = os.stat(os.path.join(dataPath, fileName))
+            fingerprint.append([fileName, fileStat.st_size, fileStat.st_mtime_ns])
+    metaFileName = os.path.join(dataPath, 'gmStore', 'meta.json')
+    if os.path.isfile(metaFileName):
+        fileStat = os.stat(metaFileName)
+        fingerprint.append(['gmStore', fileStat.st_size, fileStat.st_mtime_ns])
+    return json.dumps(fingerprint)
+
+def findRuns(root):
+    # Run directories below root, in sorted order. gmData and gmStore
+    # folders belong to their parent run and are not searched.
+    runPaths = []
+    for path, dirNames, fileNames in os.walk(root):
+        dirNames[:] = sorted(dirName for dirName in dirNames if dirName not in ('gmData', 'gmStore') and not dirName.startswith('.'))
+        if metadataFileName in fileNames or getDataPath(path) is not None:
+            runPaths.append(path)
+    return runPaths
+
+def getMapSpec(xRange, yRange, gridSize):
+    return [float(xRange[0]), float(xRange[1]), float(yRange[0]), float(yRange[1]), float(gridSize)]
+
+def isRunFinished(run, root, mapSpec):
+    # A run is finished when its consolidated results were made with the
+    # same map settings from the current gm data.
+    fileName = os.path.join(root, run['path'], resultsFileName)
+    if run['dataPath'] is None or not os.path.isfile(fileName):
+        return False
+    with np.load(fileName) as results:
+        return list(results['mapSpec']) == mapSpec \
+            and str(results['dataFingerprint']) == getDataFingerprint(os.path.join(root, run['dataPath']))
+
+def consolidateResults(run, root, mapSpec):
+    # Collects the gmMetricsValues.npz and gmStInfoValues.npz of one run into
+    # its gmRunResults.npz; station info keys are kept as they are and
+    # metrics are prefixed with 'metric_'.
+    dataPath = os.path.join(root, run['dataPath'])
+    results = {'mapSpec': np.array(mapSpec), 'dataFingerprint': np.array(getDataFingerprint(dataPath)),
+               'metadata': np.array(json.dumps(run['metadata']))}
+    with np.load(os.path.join(dataPath, 'gmMetricsValues.npz')) as gmMetrics:
+        results.update({'metric_'+key: gmMetrics[key] for key in gmMetrics.files})
+    with np.load(os.path.join(dataPath, 'gmStInfoValues.npz')) as stInfo:
+        results.update({key: stInfo[key] for key in stInfo.files})
+    tmpFileName = os.path.join(root, run['path'], resultsFileName+'.tmp.npz')
+    np.savez(tmpFileName, **results)
+    os.replace(tmpFileName, os.path.join(root, run['path'], resultsFileName))
+
+def buildCatalog(root):
+    # Scans root and returns the catalog; statuses of a previous catalog
+    # are kept for runs whose results are still present.
+    oldRuns = {run['path']: run for run in loadCatalog(root)['runs']} if os.path.isfile(os.path.join(root, catalogFileName)) else {}
+    runs = []
+    for runPath in findRuns(root):
+        relPath = os.path.relpath(runPath, root)
+        metadataPath = os.path.join(runPath, metadataFileName)
+        metadata = parseModelMetadata(metadataPath) if os.path.isfile(metadataPath) else {}
+        dataPath = getDataPath(runPath)
+        run = {'path': relPath, 'metadata': metadata, 'unknownMetadata': checkMetadata(metadata),
+               'dataPath': os.path.relpath(dataPath, root) if dataPath is not None else None,
+               'status': 'pending' if dataPath is not None else 'noData', 'mapSpec': None}
+        oldRun = oldRuns.get(relPath)
+        if oldRun is not None and oldRun['status'] == 'done' and os.path.isfile(os.path.join(runPath, resultsFileName)):
+            run['status'] = 'done'
+            run['mapSpec'] = oldRun['mapSpec']
+        runs.append(run)
+    return indexCatalog({'version': catalogVersion, 'root': os.path.abspath(root), 'runs': runs})
+
+def indexCatalog(catalog):
+    # index[key][value] lists the positions of the runs with key:value.
+    index = {}
+    for i, run in enumerate(catalog['runs']):
+        for key, value in run['metadata'].items():
+            index.setdefault(key, {}).setdefault(value, []).append(i)
+    catalog['index'] = index
+    catalog['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    return catalog
+
+def saveCatalog(catalog, root):
+    tmpFileName = os.path.join(root, catalogFileName+'.tmp')
+    with open(tmpFileName, 'w') as f:
+        json.dump(catalog, f, indent=1)
+    os.replace(tmpFileName, os.path.join(root, catalogFileName))
+
+def loadCatalog(root):
+    with open(os.path.join(root, catalogFileName), 'r') as f:
+        return json.load(f)
+
+def parseQuery(terms):
+    # ['frictionLaw:rsfs', 'velocityStructure:3D,1D'] -> {key: [values]}
+    query = {}
+    for term in terms:
+        if ':' not in term:
+            raise ValueError('query terms look like key:value, not '+term)
+        key, values = term.split(':', 1)
+        query.setdefault(key, []).extend(value for value in values.split(',') if value)
+    return query
+
+def queryRuns(catalog, query):
+    # Runs matching every key of query with any of its values, using the
+    # index of the catalog.
+    selected = set(range(len(catalog['runs'])))
+    for key, values in query.items():
+        matches = set()
+        for value in values:
+            matches.update(catalog['index'].get(key, {}).get(value, []))
+        selected = selected & matches
+    return [catalog['runs'][i] for i in sorted(selected)]
+
+def loadMetricForRuns(runs, root, key):
+    # Returns the runs that have results and their maps of metric key
+    # (ny, nx), with the x, y and Rjb maps of each run.
+    maps = []
+    for run in runs:
+        fileName = os.path.join(root, run['path'], resultsFileName)
+        if run['status'] != 'done' or not os.path.isfile(fileName):
+            continue
+        with np.load(fileName) as results:
+            if 'metric_'+key not in results.files:
+                raise ValueError(key+' is not a metric of '+run['path'])
+            maps.append((run, results['metric_'+key], results['x'], results['y'], results['Rjb']))
+    return maps
@@ -1,11 +1,16 @@
 #! /usr/bin/env python3
 
-import os, time
+import os, re, time, hashlib, fcntl
 import numpy as np
 from scipy.spatial import cKDTree
 from user_defined_params import par
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
 import pickle 
+import gmProfiler
+from gmStoreLib import gmStore, findChunkIds, getSidecarFileName, isSidecarValid
+import gmDistanceLib
 
 class parametersForGM():
     gmSamplingRate = 10
@@ -14,15 +19,28 @@ class parametersForGM():
     numOfTimeStep = round(T/dt)
     g = 9.8
     gmMetricsKeys = ['PGA', 'PGV', 'PGD', 'CAV']
-    stInfoKeys = ['Rjb', 'x', 'y']
+    stInfoKeys = ['Rjb', 'Rrup', 'Rx', 'x', 'y']
     periods = np.array([0.100, 0.125, 0.25, 0.4, 0.5, 0.75, 1, 1.5, 2, 2.5, 3, 5])
+    damping = 0.05
+    percentile = 50
     periodsKeys = [f'RSA_T_{period:.3f}' for period in periods]
     totalGMMetricsKeys = gmMetricsKeys + periodsKeys
     plotTimeseries = False
-    faultType = 'strike'
+    faultType = 'strike' # 'strike', 'trace' or 'mesh', see gmDistanceLib
     faultXmin = -20e3
     faultXmax = 20e3
+    faultTrace = None # (n, 2) array of x, y of the surface trace for faultType 'trace'
+    faultMeshPrefix = 'frt.txt' # fault node files for faultType 'mesh'
     cmap = 'inferno'
+    stBatchSize = 2000
+    numOfWorkers = 1
+    streamGM = False
+    streamBlockSize = 256
+    useCache = True
+    cacheCheckpointInterval = 60 # seconds
+    plotContours = True
+    contourKeys = None # None renders every key of totalGMMetricsKeys
+    contourDpi = 300
     
 def removeDuplicates(stLocIndex):
     uniqueData, uniqueId = np.unique(stLocIndex[:,:3], 
@@ -30,40 +48,118 @@ def removeDuplicates(stLocIndex):
                                 return_index=True)
     uniqueChunkId = stLocIndex[uniqueId,3]
     uniqueNumOfSt = stLocIndex[uniqueId,4]
-    uniqueStLocIndex = np.column_stack((uniqueData, uniqueChunkId, uniqueNumOfSt))
-    
-    np.savetxt('gmUniqueStLocIndex.txt', 
-            np.vstack(uniqueStLocIndex),
-            delimiter='\t', fmt='%.6f')
+    uniqueStIdInChunk = stLocIndex[uniqueId,5]
+    uniqueStLocIndex = np.column_stack((uniqueData, uniqueChunkId, uniqueNumOfSt, uniqueStIdInChunk))
     return uniqueStLocIndex
     
 def loadStLocForOneChunk(chunkId):
+    # Returns x, y, z, chunkId, numOfSt and stIdInChunk for every station.
     fName = 'surface_coor.txt'+str(chunkId)
-    with open(fName, 'r') as f:
-        data = np.loadtxt(fName)
+    with gmProfiler.stage('chunkCoorLoad'), open(fName, 'r') as f:
+        data = np.loadtxt(fName, ndmin=2)
         dataPlusChunkIdPlusNumOfSt = np.column_stack((data, 
             np.full(data.shape[0],chunkId), 
-            np.full(data.shape[0],data.shape[0])))
+            np.full(data.shape[0],data.shape[0]),
+            np.arange(data.shape[0])))
     return dataPlusChunkIdPlusNumOfSt 
+
+def getStLocFingerprint():
+    # (chunkId, size, mtime) of every surface_coor.txt<chunkId>; the
+    # cached station index is rebuilt whenever this changes.
+    chunkIds = findChunkIds('surface_coor.txt')
+    fingerprint = np.zeros((len(chunkIds),3), dtype=np.int64)
+    for i, chunkId in enumerate(chunkIds):
+        fileStat = os.stat('surface_coor.txt'+str(chunkId))
+        fingerprint[i] = [chunkId, fileStat.st_size, fileStat.st_mtime_ns]
+    return fingerprint
+
+class gmStLocIndex():
+    # Unique station locations of a dataset as an (n, 6) array of
+    # x, y, z, chunkId, numOfSt and stIdInChunk, plus its KD-tree.
+    # Indexing an instance indexes the underlying array.
+    indexFileName = 'gmStLocIndex.npz'
+    treeFileName = 'gmStLocIndexTree.pickle'
+
+    def __init__(self, data, tree=None):
+        self.data = data
+        if tree is None:
+            tree = cKDTree(data[:,:3])
+        self.tree = tree
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def query(self, queryPoints):
+        # Returns the row ids of the nearest stations.
+        with gmProfiler.stage('kdTreeLookup'):
+            return self.tree.query(queryPoints)[1]
+
+    def save(self, fingerprint):
+        np.savez(self.indexFileName,
+                 coor=self.data[:,:3],
+                 chunkId=self.data[:,3].astype(np.int64),
+                 numOfSt=self.data[:,4].astype(np.int64),
+                 stIdInChunk=self.data[:,5].astype(np.int64),
+                 fingerprint=fingerprint)
+        with open(self.treeFileName, 'wb') as f:
+            pickle.dump((fingerprint, self.tree), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, fingerprint):
+        # Returns None if the cached index is missing or out of date.
+        if not os.path.isfile(cls.indexFileName):
+            return None
+        with np.load(cls.indexFileName) as index:
+            if not np.array_equal(index['fingerprint'], fingerprint):
+                return None
+            data = np.column_stack((index['coor'], index['chunkId'],
+                                    index['numOfSt'], index['stIdInChunk'])).astype(np.float64)
+
+        tree = None
+        if os.path.isfile(cls.treeFileName):
+            with open(cls.treeFileName, 'rb') as f:
+                treeFingerprint, tree = pickle.load(f)
+            if not np.array_equal(treeFingerprint, fingerprint):
+                tree = None
+        stLocIndex = cls(data, tree)
+        if tree is None:
+            stLocIndex.save(fingerprint)
+        return stLocIndex
     
-def buildStLocIndex(numOfProcessors):
+def buildStLocIndex():
     stLocIndex = []
-    for chunkId in range(numOfProcessors):
-        fName = 'surface_coor.txt'+str(chunkId)
-        if os.path.isfile(fName):
-            data = loadStLocForOneChunk(chunkId)
-            stLocIndex.append(data)
-    
-    np.savetxt('gmStLocIndex.txt', 
-                np.vstack(stLocIndex),
-                delimiter='\t', fmt='%.6f')
+    fingerprint = getStLocFingerprint()
+    for chunkId in fingerprint[:,0]:
+        data = loadStLocForOneChunk(int(chunkId))
+        stLocIndex.append(data)
     
-    uniqueStLocIndex = removeDuplicates(np.vstack(stLocIndex))
+    uniqueStLocIndex = gmStLocIndex(removeDuplicates(np.vstack(stLocIndex)))
+    uniqueStLocIndex.save(fingerprint)
     return uniqueStLocIndex
 
+def loadStLocIndex():
+    # Loads the binary station index of the current dataset, rebuilding it
+    # when any surface_coor.txt<chunkId> has been added, removed or changed.
+    # Archived runs without surface_coor.txt files use the index embedded in
+    # the gm store, cached against the fingerprint of its meta.json.
+    if len(findChunkIds('surface_coor.txt')) == 0 and gmStore.exists():
+        fingerprint = gmStore.getFingerprint()
+        stLocIndex = gmStLocIndex.load(fingerprint)
+        if stLocIndex is None:
+            stLocIndex = gmStLocIndex(gmStore().loadStLocIndex())
+            stLocIndex.save(fingerprint)
+        return stLocIndex
+    stLocIndex = gmStLocIndex.load(getStLocFingerprint())
+    if stLocIndex is None:
+        print(' Building station index '+gmStLocIndex.indexFileName+' ...')
+        stLocIndex = buildStLocIndex()
+    return stLocIndex
+
 def getNearestStLocAndChunkId(queryPoint, stLocIndex):
-    tree = cKDTree(stLocIndex[:,:3])
-    stIdGlobal = tree.query(queryPoint)[1]
+    stIdGlobal = stLocIndex.query(queryPoint)
     
     stInfo = {}
     stInfo['X'] = stLocIndex[stIdGlobal][0]
@@ -72,39 +168,106 @@ def getNearestStLocAndChunkId(queryPoint, stLocIndex):
     chunkId = int(stLocIndex[stIdGlobal][3])
     stInfo['chunkId'] = chunkId
     stInfo['numOfSt'] = int(stLocIndex[stIdGlobal][4])
-    
-    stLocIndexOneChunk = loadStLocForOneChunk(chunkId)
-    tree = cKDTree(stLocIndexOneChunk[:,:3])
-    stIdInChunk = tree.query(queryPoint)[1]
-    stInfo['stIdInChunk'] = int(stIdInChunk)
+    stInfo['stIdInChunk'] = int(stLocIndex[stIdGlobal][5])
 
     return stInfo
 
+class gmChunkReader():
+    # Memory-mapped view of one gm<chunkId> file. EQdyna writes the file
+    # time-major, so it is viewed as a (numOfTimeStep, numOfSt, 3) array and
+    # whole traces are returned as strided slices without per-sample seeks.
+    # A station-major sidecar gm<chunkId>.stmajor written by gmTranspose is
+    # preferred, since each trace is then one contiguous read. Without the gm
+    # file, the station-major blocks of the gm store are read.
+    def __init__(self, chunkId, numOfSt, fileNamePrefix='gm', dtype=np.float64):
+        self.chunkId = chunkId
+        self.numOfSt = numOfSt
+        self.fileName = fileNamePrefix+str(chunkId)
+        self.dtype = dtype
+        valueSize = np.dtype(dtype).itemsize
+        self.store = None
+        self.sidecar = None
+        if isSidecarValid(self.fileName, numOfSt, valueSize):
+            sidecarFileName = getSidecarFileName(self.fileName)
+            self.numOfTimeStep = int(os.path.getsize(sidecarFileName)/valueSize/numOfSt/3)
+            self.sidecar = np.memmap(sidecarFileName, dtype=dtype, mode='r',
+                                     shape=(numOfSt, 3, self.numOfTimeStep))
+            return
+        if not os.path.isfile(self.fileName) and gmStore.exists():
+            self.store = gmStore()
+            self.numOfTimeStep = self.store.numOfTimeStep
+            return
+
+        fileSize = os.path.getsize(self.fileName)
+        numOfDataPoints = int(fileSize/valueSize)
+        self.numOfTimeStep = int(numOfDataPoints/numOfSt/3)
+        self.data = np.memmap(self.fileName, dtype=dtype, mode='r',
+                              shape=(self.numOfTimeStep, numOfSt, 3))
+
+    def getTraces(self, stIds):
+        # Returns (numOfTimeStep, 3) for a single station id or
+        # (numOfTimeStep, len(stIds), 3) for a batch of station ids.
+        if self.store is not None or self.sidecar is not None:
+            return np.moveaxis(self.getStationMajor(stIds), -1, 0)
+        with gmProfiler.stage('traceRead'):
+            traces = np.array(self.data[:, stIds, :])
+        gmProfiler.addBytesRead(self.chunkId, traces.nbytes)
+        return traces
+
+    def getStationMajor(self, stIds):
+        # (3, numOfTimeStep) or (len(stIds), 3, numOfTimeStep) from the
+        # sidecar or the store.
+        with gmProfiler.stage('traceRead'):
+            if self.sidecar is not None:
+                traces = np.array(self.sidecar[stIds])
+            else:
+                traces = self.store.getStationMajor(self.chunkId, stIds)
+        gmProfiler.addBytesRead(self.chunkId, traces.nbytes)
+        return traces
+
+    def getVel(self, stIds):
+        # Returns along-strike and fault-normal velocities with time as the
+        # last axis, i.e. (numOfTimeStep,) or (len(stIds), numOfTimeStep).
+        if self.store is not None or self.sidecar is not None:
+            traces = self.getStationMajor(stIds)
+            return np.ascontiguousarray(traces[...,0,:]), np.ascontiguousarray(traces[...,1,:])
+        traces = self.getTraces(stIds)
+        velAlongStrike = np.ascontiguousarray(np.moveaxis(traces[...,0], 0, -1))
+        velFaultNormal = np.ascontiguousarray(np.moveaxis(traces[...,1], 0, -1))
+        return velAlongStrike, velFaultNormal
+
+    def iterVelBlocks(self, stIds, blockSize):
+        # Yields getVel(stIds) for consecutive blocks of at most blockSize
+        # time steps, reading the file once from start to end. Traces in the
+        # gm store are station-major, so they are read whole and split.
+        if self.sidecar is not None:
+            for start in range(0, self.numOfTimeStep, blockSize):
+                with gmProfiler.stage('traceRead'):
+                    traces = np.array(self.sidecar[stIds, :2, start:start+blockSize])
+                gmProfiler.addBytesRead(self.chunkId, traces.nbytes)
+                yield np.ascontiguousarray(traces[:,0]), np.ascontiguousarray(traces[:,1])
+            return
+        if self.store is not None:
+            velAlongStrike, velFaultNormal = self.getVel(stIds)
+            for start in range(0, self.numOfTimeStep, blockSize):
+                yield velAlongStrike[:,start:start+blockSize], velFaultNormal[:,start:start+blockSize]
+            return
+        for start in range(0, self.numOfTimeStep, blockSize):
+            with gmProfiler.stage('traceRead'):
+                traces = np.array(self.data[start:start+blockSize, stIds, :2])
+            gmProfiler.addBytesRead(self.chunkId, traces.nbytes)
+            yield np.ascontiguousarray(traces[...,0].T), np.ascontiguousarray(traces[...,1].T)
+
 def extractVel(stInfo):
-    dtype = np.float64
-    valueSize = np.dtype(dtype).itemsize
-    
     chunkId = stInfo['chunkId']
     numOfSt = stInfo['numOfSt']
     stId = stInfo['stIdInChunk']
     
     gmBinaryFileName = 'gm'+str(chunkId)
     
-    if os.path.isfile(gmBinaryFileName):
-        fileSize = os.path.getsize(gmBinaryFileName)
-        numOfDataPoints = int(fileSize/valueSize)
-        numOfTimeStep = int(numOfDataPoints/numOfSt/3)
-        velAlongStrike = np.empty(numOfTimeStep)
-        velFaultNormal = np.empty(numOfTimeStep)
-        
-        indexForAlongStrike = np.arange(numOfTimeStep)*numOfSt*3+stId*3
-        
-        with open(gmBinaryFileName, 'rb') as f:
-            for i, index in enumerate(indexForAlongStrike):
-                f.seek(index*valueSize)
-                values = np.fromfile(f, dtype=dtype, count=3) 
-                velAlongStrike[i] = values[0]
-                velFaultNormal[i] = values[1]
+    if os.path.isfile(gmBinaryFileName) or isSidecarValid(gmBinaryFileName, numOfSt) or gmStore.exists():
+        reader = gmChunkReader(chunkId, numOfSt)
+        velAlongStrike, velFaultNormal = reader.getVel(stId)
                 
         np.savetxt('gmSt1.txt', 
                 velAlongStrike,
@@ -115,34 +278,33 @@ def extractVel(stInfo):
 def plotAndSaveTimeseries(stLoc, ts1, ts2, var, par):
     dt = par.dt
     
-    fig, ax = plt.subplots()
-    
-    numOfTimeSteps = ts1.shape[0]
-    time = np.arange(numOfTimeSteps)*dt 
-    ax.plot(time, ts1, label='Along-Strike')
-    ax.plot(time, ts2, label='Fault-Normal')
+    with gmProfiler.stage('plotting'):
+        fig, ax = plt.subplots()
+        
+        numOfTimeSteps = ts1.shape[0]
+        time = np.arange(numOfTimeSteps)*dt 
+        ax.plot(time, ts1, label='Along-Strike')
+        ax.plot(time, ts2, label='Fault-Normal')
 
-    ax.set_xlabel('Time (s)')
-    if var == 'Vel':
-        ax.set_ylabel(var+ ' (m/s)')
-    elif var == 'Acc':
-        ax.set_ylabel(var + ' (m/s/s)')
-    ax.legend()
+        ax.set_xlabel('Time (s)')
+        if var == 'Vel':
+            ax.set_ylabel(var+ ' (m/s)')
+        elif var == 'Acc':
+            ax.set_ylabel(var + ' (m/s/s)')
+        ax.legend()
 
-    output_file = 'gm'+var+'ST'+str(stLoc[0])+'FN'+str(stLoc[1])+'.png'
-    plt.savefig(output_file, dpi=300, bbox_inches='tight')
+        output_file = 'gm'+var+'ST'+str(stLoc[0])+'FN'+str(stLoc[1])+'.png'
+        plt.savefig(output_file, dpi=300, bbox_inches='tight')
 
 def velToAcc(velAlongStrike, velFaultNormal, par):
-    #accAlongStrike = np.diff(velAlongStrike)/dt
-    #accFaultNormal = np.diff(velFaultNormal)/dt
-    
+    # Works on a single trace or on a batch of traces with time as the last
+    # axis; the first sample of acceleration is zero.
     dt = par.dt
-    numOfTimeStep = velAlongStrike.shape[0]
-    accAlongStrike = np.zeros(numOfTimeStep)
-    accFaultNormal = np.zeros(numOfTimeStep)
-    for i in range(1,numOfTimeStep):
-        accAlongStrike[i] = (velAlongStrike[i] - velAlongStrike[i-1])/dt
-        accFaultNormal[i] = (velFaultNormal[i] - velFaultNormal[i-1])/dt
+    with gmProfiler.stage('velToAcc'):
+        accAlongStrike = np.zeros_like(velAlongStrike)
+        accFaultNormal = np.zeros_like(velFaultNormal)
+        accAlongStrike[...,1:] = np.diff(velAlongStrike, axis=-1)/dt
+        accFaultNormal[...,1:] = np.diff(velFaultNormal, axis=-1)/dt
 
     return accAlongStrike, accFaultNormal
 
@@ -153,64 +315,334 @@ def calcGMMetricsFromAccForOneSt(accx, accy, par):
     accx = accx*100 # convert to cm/s/s 
     accy = accy*100
     periods = par.periods
-    result = gmrotdpp_withPG(accx, dt, accy, dt, periods, percentile=50, damping=0.05, units='cm/s/s', method='Nigam-Jennings')
+    result = gmrotdpp_withPG(accx, dt, accy, dt, periods, percentile=par.percentile, damping=par.damping, units='cm/s/s', method='Nigam-Jennings')
     
     return result
     
+def calcGMMetricsFromAccForStations(accx, accy, par):
+    # accx and accy are (numOfSt, numOfTimeStep); returns a dict of arrays
+    # of length numOfSt keyed by par.totalGMMetricsKeys.
+    from ComputeGroundMotionParametersFromSurfaceOutput_Hybrid_Lite import gmrotdpp_withPG_batch
+
+    dt = par.dt
+    accx = accx*100 # convert to cm/s/s 
+    accy = accy*100
+    periods = par.periods
+    result = gmrotdpp_withPG_batch(accx, dt, accy, periods, percentile=par.percentile, damping=par.damping, units='cm/s/s', method='Nigam-Jennings')
+    return unpackGMMetricsForStations(result, par)
+
+def unpackGMMetricsForStations(result, par):
+    # Flattens the result of gmrotdpp_withPG_batch to par.totalGMMetricsKeys.
+    gmMetricsValues = {key: result[key] for key in par.gmMetricsKeys}
+    for iPeriod, key in enumerate(par.periodsKeys):
+        gmMetricsValues[key] = result['Acceleration'][:,iPeriod]
+    return gmMetricsValues
+
+def unpackGMMetrics(gmMetricsOneSt, par):
+    # Flattens the result of gmrotdpp_withPG to par.totalGMMetricsKeys.
+    gmMetricsValues = {key: np.float64(0.0) for key in par.totalGMMetricsKeys}
+    for key in par.gmMetricsKeys:
+        gmMetricsValues[key] = gmMetricsOneSt.get(key, 0.0) # default to 0.0 if key is not found.
+    
+    rsaDict = {key: value for key, value in zip(par.periodsKeys, gmMetricsOneSt['Acceleration'])}
+    for key in par.periodsKeys:
+        gmMetricsValues[key] = rsaDict.get(key, 0.0)
+    return gmMetricsValues
+
+def getContourUnit(key):
+    if 'RSA' in key or 'PGA' in key:
+        unit = 'cm/s/s'
+    elif 'PGV' in key or 'CAV' in key:
+        unit = 'cm/s'
+    elif 'PGD' in key:
+        unit = 'cm'
+    else:
+        unit = ''
+    return unit
+
+def plotAndSaveGMMetricsContour(xx, yy, key, values, cmap, dpi):
+    # Renders one metric to gmContour<key>.png. The figure is built
+    # without pyplot, so nothing stays registered once it is saved and the
+    # function can run in worker processes.
+    fig = Figure()
+    ax = fig.add_subplot()
+    fontsize = 12
+    cs = ax.contourf(xx/1e3, yy/1e3, values, levels=20, cmap=cmap)
+    cb = fig.colorbar(cs, ax=ax, label=str(getContourUnit(key)), orientation='horizontal')
+    cb.ax.tick_params(labelsize=fontsize)
+    cb.ax.yaxis.offsetText.set_fontsize(fontsize)
+    ax.set_title(key, fontsize=fontsize, fontweight='bold')
+    ax.set_xlabel('Along Strike (km)', fontsize=fontsize, fontweight='bold')
+    ax.set_ylabel('Fault Normal (km)', fontsize=fontsize, fontweight='bold')
+    ax.set_aspect('equal')
+    ax.tick_params(labelsize=fontsize)
+    fig.savefig(f'gmContour{key}.png', dpi=dpi)
+    return key
+
+def getContourKeys(par):
+    # Keys selected for rendering; unknown keys are reported and skipped.
+    if par.contourKeys is None:
+        return list(par.totalGMMetricsKeys)
+    keys = [key for key in par.contourKeys if key in par.totalGMMetricsKeys]
+    for key in par.contourKeys:
+        if key not in par.totalGMMetricsKeys:
+            print('Unknown GM metric '+key+' is not plotted.')
+    return keys
+
 def plotAndSaveGMMetricsContours(xx, yy, gmMetricsValues, par):
-    for key in par.totalGMMetricsKeys:
-        if 'RSA' in key or 'PGA' in key:
-            unit = 'cm/s/s'
-        elif 'PGV' in key or 'CAV' in key:
-            unit = 'cm/s'
-        elif 'PGD' in key:
-            unit = 'cm'
+    # Renders the selected metrics (par.contourKeys), spreading them over
+    # par.numOfWorkers processes. gmMetricsValues may be a dict or a lazily
+    # loaded npz file; only the selected keys are read.
+    keys = getContourKeys(par)
+    with gmProfiler.stage('plotting'):
+        if par.numOfWorkers > 1 and len(keys) > 1:
+            with ProcessPoolExecutor(max_workers=min(par.numOfWorkers, len(keys))) as executor:
+                futures = [executor.submit(plotAndSaveGMMetricsContour, xx, yy, key, gmMetricsValues[key], par.cmap, par.contourDpi) for key in keys]
+                for future in futures:
+                    future.result()
         else:
-            unit = ''
-
-        fig = plt.figure()
-        ax = plt.gca()
-        fontsize = 12
-        plt.contourf(xx/1e3, yy/1e3, gmMetricsValues[key], levels=20, cmap=par.cmap)
-        cb = plt.colorbar(label=str(unit), orientation='horizontal')
-        cb.ax.tick_params(labelsize=fontsize)
-        cb.ax.yaxis.offsetText.set_fontsize(fontsize)
-        ax.set_title(key, fontsize=fontsize, fontweight='bold')
-        ax.set_xlabel('Along Strike (km)', fontsize=fontsize, fontweight='bold')
-        ax.set_ylabel('Fault Normal (km)', fontsize=fontsize, fontweight='bold')
-        ax.set_aspect('equal')
-        plt.xticks(fontsize=fontsize)
-        plt.yticks(fontsize=fontsize)
-        plt.savefig(f'gmContour{key}.png', dpi=300)
-
-        with open(f'gmContour{key}.pickle', 'wb') as f:
-            pickle.dump(fig, f)
+            for key in keys:
+                plotAndSaveGMMetricsContour(xx, yy, key, gmMetricsValues[key], par.cmap, par.contourDpi)
+    print(str(len(keys))+' contour maps are rendered.')
+
+def plotGMMetricsContoursFromFile(par, fileName='gmMetricsValues.npz', stInfoFileName='gmStInfoValues.npz'):
+    # Renders contours of a finished map run from its saved values, without
+    # touching the gm files.
+    with np.load(stInfoFileName) as gmStInfoValues, np.load(fileName) as gmMetricsValues:
+        plotAndSaveGMMetricsContours(gmStInfoValues['x'], gmStInfoValues['y'], gmMetricsValues, par)
 
 def saveGMMetricsValues(gmMetricsValues, fileName):
     np.savez(fileName, **gmMetricsValues)
 
 def getGMMetricsForOneSt(stLoc, stLocIndex, par):
     #stLoc = np.array([x,y,0])
-    gmMetricsValues = {key: np.float64(0.0) for key in par.totalGMMetricsKeys} 
-    
     stInfo = getNearestStLocAndChunkId(stLoc, stLocIndex)
     #print('Input stLoc', stLoc, 'returned stInfo', stInfo)
     velAlongStrike, velFaultNormal = extractVel(stInfo)
     accAlongStrike, accFaultNormal = velToAcc(velAlongStrike, velFaultNormal, par)
     
     gmMetricsOneSt = calcGMMetricsFromAccForOneSt(accAlongStrike, accFaultNormal, par)
-    for key in par.gmMetricsKeys:
-        gmMetricsValues[key] = gmMetricsOneSt.get(key, 0.0) # default to 0.0 if key is not found.
-    
-    rsaDict = {key: value for key, value in zip(par.periodsKeys, gmMetricsOneSt['Acceleration'])}
-    for key in par.periodsKeys:
-        gmMetricsValues[key] = rsaDict.get(key, 0.0)
+    gmMetricsValues = unpackGMMetrics(gmMetricsOneSt, par)
     
     if par.plotTimeseries==True:
         plotAndSaveTimeseries(stLoc, velAlongStrike, velFaultNormal, 'Vel', par)
         plotAndSaveTimeseries(stLoc, accAlongStrike, accFaultNormal, 'Acc', par)
         
     return gmMetricsValues
+
+def groupStationsByChunk(stIdGlobal, stLocIndex):
+    # Groups rows of the station index by chunkId. Returns a dict
+    # chunkId -> (stLocIds, numOfSt, stIdsInChunk), where stLocIds are
+    # positions in stIdGlobal.
+    chunkIds = stLocIndex[stIdGlobal,3].astype(int)
+    numOfSts = stLocIndex[stIdGlobal,4].astype(int)
+    stIdsInChunk = stLocIndex[stIdGlobal,5].astype(int)
+
+    stLocGroups = {}
+    for chunkId in np.unique(chunkIds):
+        stLocIds = np.nonzero(chunkIds==chunkId)[0]
+        stLocGroups[int(chunkId)] = (stLocIds, int(numOfSts[stLocIds[0]]), stIdsInChunk[stLocIds])
+    return stLocGroups
+
+def getGMMetricsForOneChunkStreaming(chunkId, numOfSt, stIdsInChunk, par):
+    # Reads gm<chunkId> in blocks of par.streamBlockSize time steps and
+    # updates running peaks, CAV integrals and oscillator states of all
+    # requested stations, so memory does not grow with the trace length.
+    from ComputeGroundMotionParametersFromSurfaceOutput_Hybrid_Lite import gmrotdppAccumulator
+
+    reader = gmChunkReader(chunkId, numOfSt)
+    accumulator = gmrotdppAccumulator(len(stIdsInChunk), reader.numOfTimeStep, par.dt, par.periods,
+                                      percentile=par.percentile, damping=par.damping, units='cm/s/s')
+    lastVel = None
+    for vel in reader.iterVelBlocks(stIdsInChunk, par.streamBlockSize):
+        if lastVel is None:
+            acc = velToAcc(vel[0], vel[1], par)
+        else:
+            acc = velToAcc(np.column_stack((lastVel[0], vel[0])),
+                           np.column_stack((lastVel[1], vel[1])), par)
+            acc = (acc[0][:,1:], acc[1][:,1:])
+        accumulator.update(acc[0]*100, acc[1]*100) # convert to cm/s/s 
+        lastVel = (vel[0][:,-1], vel[1][:,-1])
+
+    return unpackGMMetricsForStations(accumulator.result(), par)
+
+def getGMMetricsForOneChunk(chunkId, numOfSt, stIdsInChunk, par, reader=None):
+    # Reads the traces of all requested stations of one chunk in a single
+    # pass over gm<chunkId> and hands them to the metric kernel. A
+    # long-lived caller such as gmServer passes its open reader.
+    gmProfiler.addCount('stations', len(stIdsInChunk))
+    if par.streamGM == True:
+        return getGMMetricsForOneChunkStreaming(chunkId, numOfSt, stIdsInChunk, par)
+
+    gmMetricsValues = {key: np.zeros(len(stIdsInChunk)) for key in par.totalGMMetricsKeys}
+    if reader is None:
+        reader = gmChunkReader(chunkId, numOfSt)
+    for start in range(0, len(stIdsInChunk), par.stBatchSize):
+        batch = slice(start, start+par.stBatchSize)
+        velAlongStrike, velFaultNormal = reader.getVel(stIdsInChunk[batch])
+        accAlongStrike, accFaultNormal = velToAcc(velAlongStrike, velFaultNormal, par)
+        gmMetricsValuesOneBatch = calcGMMetricsFromAccForStations(accAlongStrike, accFaultNormal, par)
+        for key in par.totalGMMetricsKeys:
+            gmMetricsValues[key][batch] = gmMetricsValuesOneBatch[key]
+    return gmMetricsValues
+
+def shardStLocGroups(stLocGroups, par):
+    # Splits every chunk into shards of at most par.stBatchSize stations.
+    # Returns a list of (chunkId, numOfSt, stIdsInChunk, stLocIds) in
+    # chunk order.
+    shards = []
+    for chunkId, (stLocIds, numOfSt, stIdsInChunk) in stLocGroups.items():
+        for start in range(0, len(stLocIds), par.stBatchSize):
+            batch = slice(start, start+par.stBatchSize)
+            shards.append((chunkId, numOfSt, stIdsInChunk[batch], stLocIds[batch]))
+    return shards
+
+def getGMMetricsCacheKey(par):
+    # Hash of everything a cached station metric depends on: dt, periods,
+    # damping, percentile and the size and mtime of every gm<chunkId>.
+    chunkIds = findChunkIds('gm')
+    fingerprint = np.zeros((len(chunkIds),3), dtype=np.int64)
+    for i, chunkId in enumerate(chunkIds):
+        fileStat = os.stat('gm'+str(chunkId))
+        fingerprint[i] = [chunkId, fileStat.st_size, fileStat.st_mtime_ns]
+    if len(chunkIds) == 0 and gmStore.exists():
+        fingerprint = gmStore.getFingerprint()
+
+    h = hashlib.sha1()
+    h.update(repr((float(par.dt), float(par.damping), float(par.percentile))).encode())
+    h.update(np.asarray(par.periods, dtype=np.float64).tobytes())
+    h.update(fingerprint.tobytes())
+    return h.hexdigest()[:16]
+
+class gmMetricsCache():
+    # On-disk cache of station metrics, one column per metric plus the
+    # station key chunkId*2**32+stIdInChunk, in gmMetricsCache_<key>.npz.
+    # The key comes from getGMMetricsCacheKey, so changing dt, periods,
+    # damping, percentile or any gm file starts a new cache.
+    def __init__(self, par):
+        self.keys = par.totalGMMetricsKeys
+        self.fileName = 'gmMetricsCache_'+getGMMetricsCacheKey(par)+'.npz'
+        self.checkpointInterval = par.cacheCheckpointInterval
+        self.stKeys, self.values = self.load()
+        self.newEntries = []
+        self.lastSaveTime = time.time()
+
+    def load(self):
+        if os.path.isfile(self.fileName):
+            with np.load(self.fileName) as cache:
+                if all(key in cache for key in self.keys):
+                    return cache['stKey'], {key: cache[key] for key in self.keys}
+        return np.zeros(0, dtype=np.int64), {key: np.zeros(0) for key in self.keys}
+
+    def makeStKeys(self, chunkId, stIdsInChunk):
+        return np.int64(chunkId)*2**32 + np.asarray(stIdsInChunk, dtype=np.int64)
+
+    def lookup(self, chunkId, stIdsInChunk):
+        # Returns a mask of the stations found in the cache and a dict of
+        # their values.
+        stKeys = self.makeStKeys(chunkId, stIdsInChunk)
+        if len(self.stKeys) == 0:
+            return np.zeros(len(stKeys), dtype=bool), {key: np.zeros(0) for key in self.keys}
+        pos = np.minimum(np.searchsorted(self.stKeys, stKeys), len(self.stKeys)-1)
+        found = self.stKeys[pos] == stKeys
+        return found, {key: self.values[key][pos[found]] for key in self.keys}
+
+    def add(self, chunkId, stIdsInChunk, gmMetricsValues):
+        self.newEntries.append((self.makeStKeys(chunkId, stIdsInChunk),
+                                {key: np.asarray(gmMetricsValues[key]) for key in self.keys}))
+        if time.time()-self.lastSaveTime > self.checkpointInterval:
+            self.save()
+
+    def save(self):
+        # Merges new entries with the file as it is on disk, so concurrent
+        # runs on the same dataset keep each other's entries, and rewrites
+        # it atomically. Writers are serialized by a lock file.
+        if len(self.newEntries) == 0:
+            return
+        with open(self.fileName+'.lock', 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            diskStKeys, diskValues = self.load()
+            stKeys = np.concatenate([diskStKeys, self.stKeys]+[entry[0] for entry in self.newEntries])
+            values = {key: np.concatenate([diskValues[key], self.values[key]]+[entry[1][key] for entry in self.newEntries])
+                      for key in self.keys}
+            stKeys, uniqueId = np.unique(stKeys, return_index=True)
+            self.stKeys = stKeys
+            self.values = {key: values[key][uniqueId] for key in self.keys}
+            self.newEntries = []
+
+            tmpFileName = self.fileName+'.tmp'+str(os.getpid())+'.npz'
+            np.savez(tmpFileName, stKey=self.stKeys, **self.values)
+            os.replace(tmpFileName, self.fileName)
+        self.lastSaveTime = time.time()
+
+def getGMMetricsForStations(stLocs, stLocIndex, par):
+    # Batch counterpart of getGMMetricsForOneSt for an (n, 3) array of
+    # query points. Metrics are computed once per unique simulation
+    # station and scattered back to the points. Each chunk's shards are
+    # processed serially or, with par.numOfWorkers > 1, across a process
+    # pool. Results are assembled in shard order, so both paths give
+    # identical outputs. With par.useCache, stations found in the
+    # metrics cache are skipped and new results are checkpointed to it.
+
+    # all query points are resolved with one KD-tree query; points that
+    # snap to the same simulation station share one computation
+    stIdGlobal, stIdGlobalToStLoc = np.unique(stLocIndex.query(stLocs), return_inverse=True)
+    print(' '+str(len(stIdGlobal))+' unique simulation stations are used for '+str(stLocs.shape[0])+' points.')
+
+    gmMetricsValues = {key: np.zeros(len(stIdGlobal)) for key in par.totalGMMetricsKeys}
+    stLocGroups = groupStationsByChunk(stIdGlobal, stLocIndex)
+
+    cache = None
+    if par.useCache == True:
+        cache = gmMetricsCache(par)
+        numOfCachedSt = 0
+        for chunkId, (stLocIds, numOfSt, stIdsInChunk) in stLocGroups.items():
+            found, cachedValues = cache.lookup(chunkId, stIdsInChunk)
+            for key in par.totalGMMetricsKeys:
+                gmMetricsValues[key][stLocIds[found]] = cachedValues[key]
+            stLocGroups[chunkId] = (stLocIds[~found], numOfSt, stIdsInChunk[~found])
+            numOfCachedSt = numOfCachedSt + np.count_nonzero(found)
+        print(' '+str(numOfCachedSt)+' of '+str(len(stIdGlobal))+' stations are found in '+cache.fileName)
+        stLocGroups = {chunkId: group for chunkId, group in stLocGroups.items() if len(group[0]) > 0}
+
+    shards = shardStLocGroups(stLocGroups, par)
+
+    chunkIds = [shard[0] for shard in shards]
+    numOfSts = [shard[1] for shard in shards]
+    stIdsInChunks = [shard[2] for shard in shards]
+    pars = [par]*len(shards)
+
+    if par.numOfWorkers > 1:
+        print(' Using '+str(par.numOfWorkers)+' workers for '+str(len(shards))+' shards.')
+        executor = ProcessPoolExecutor(max_workers=par.numOfWorkers)
+        if gmProfiler.enabled:
+            # timers recorded in the workers are sent back with the results
+            results = executor.map(gmProfiler.callAndSnapshot, [getGMMetricsForOneChunk]*len(shards), chunkIds, numOfSts, stIdsInChunks, pars)
+            results = gmProfiler.mergeResults(results)
+        else:
+            results = executor.map(getGMMetricsForOneChunk, chunkIds, numOfSts, stIdsInChunks, pars)
+    else:
+        executor = None
+        results = map(getGMMetricsForOneChunk, chunkIds, numOfSts, stIdsInChunks, pars)
+
+    stTag = 0
+    try:
+        for shard, gmMetricsValuesOneShard in zip(shards, results):
+            chunkId, numOfSt, stIdsInChunk, stLocIds = shard
+            for key in par.totalGMMetricsKeys:
+                gmMetricsValues[key][stLocIds] = gmMetricsValuesOneShard[key]
+            if cache is not None:
+                cache.add(chunkId, stIdsInChunk, gmMetricsValuesOneShard)
+
+            stTag = stTag + len(stLocIds)
+            print(str(stTag)+' stations are processed ...')
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if cache is not None:
+            cache.save()
+
+    return {key: gmMetricsValues[key][stIdGlobalToStLoc] for key in par.totalGMMetricsKeys}
     
 def getGMMetricsFor2DMap(xRange, yRange, gridSize, stLocIndex, par):
     # making contours
@@ -224,44 +656,24 @@ def getGMMetricsFor2DMap(xRange, yRange, gridSize, stLocIndex, par):
     yArr = np.linspace(y_min, y_max, ny)
 
     xx, yy = np.meshgrid(xArr, yArr)
+    stLocs = np.column_stack((xx.ravel(), yy.ravel(), np.zeros(xx.size)))
+
+    gmMetricsValuesForStations = getGMMetricsForStations(stLocs, stLocIndex, par)
+    gmMetricsValues = {key: gmMetricsValuesForStations[key].reshape(xx.shape) for key in par.totalGMMetricsKeys}
+
+    with gmProfiler.stage('distances'):
+        distances = gmDistanceLib.getDistances(stLocs, par, useCache=par.useCache)
+    stInfo = {'x': xx, 'y': yy, **{key: distances[key].reshape(xx.shape) for key in distances}}
+    gmStInfoValues = {key: stInfo[key] for key in par.stInfoKeys}
 
-    gmMetricsValues = {key: np.zeros_like(xx) for key in par.totalGMMetricsKeys} #np.zeros_like(xx)
-    gmStInfoValues = {key: np.zeros_like(xx) for key in par.stInfoKeys}
-    
-    stTag = 0
-    for i in range(nx):
-        for j in range(ny):
-            if stTag % 100 == 0:
-                print(str(stTag)+' stations are processed ...')
-            x = xx[j,i]
-            y = yy[j,i]
-            stLoc = np.array([x,y,0])
-            gmMetricsValuesForOneSt = getGMMetricsForOneSt(stLoc, stLocIndex, par)
-            
-            for key in par.totalGMMetricsKeys:
-                gmMetricsValues[key][j,i] = gmMetricsValuesForOneSt.get(key, 0.0)
-            
-            Rjb = calcRjb(stLoc, par)
-            gmStInfoValues['Rjb'][j,i] = Rjb
-            gmStInfoValues['x'][j,i] = x
-            gmStInfoValues['y'][j,i] = y
-            
-            stTag = stTag + 1
-
-    plotAndSaveGMMetricsContours(xx, yy, gmMetricsValues, par)
     saveGMMetricsValues(gmMetricsValues, 'gmMetricsValues.npz')
     saveGMMetricsValues(gmStInfoValues, 'gmStInfoValues.npz')
+    if par.plotContours == True:
+        plotAndSaveGMMetricsContours(xx, yy, gmMetricsValues, par)
     
-    print('Total time used is ', time.time()-startTime, ' for ', stTag, ' stations.')
+    print('Total time used is ', time.time()-startTime, ' for ', stLocs.shape[0], ' stations.')
     
 def calcRjb(stLoc, par):
-    if par.faultType == 'strike':
-        if stLoc[0]<=par.faultXmin:
-            Rjb = ((stLoc[0]-par.faultXmin)**2 + stLoc[1]**2)**0.5
-        elif stLoc[0]>=par.faultXmax:
-            Rjb = ((stLoc[0]-par.faultXmax)**2 + stLoc[1]**2)**0.5
-        else:
-            Rjb = abs(stLoc[1])
-    
-    return Rjb 
+    # Rjb of a single station; use gmDistanceLib.getDistances for many.
+    return gmDistanceLib.calcDistances(np.atleast_2d(np.asarray(stLoc, dtype=np.float64)), par)['Rjb'][0] 
 
@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+# Stage timers for dr4gm. Profiling is off unless DR4GM_PROFILE is set (1 for
+# timers, cprofile for timers plus a cProfile dump) or gmProcessor is run
+# with --profile/--cprofile. When off, stage() returns a shared no-op context
+# and the counters return immediately.
+import os, time, json, cProfile
+from contextlib import nullcontext
+
+mode = os.environ.get('DR4GM_PROFILE', '').lower()
+enabled = mode not in ('', '0', 'false', 'no')
+stages = {} # stage -> [seconds, calls]
+counters = {} # name -> value
+bytesReadPerChunk = {} # chunkId -> bytes
+profiler = None
+noStage = nullcontext()
+
+class stageTimer():
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *excInfo):
+        record = stages.setdefault(self.name, [0.0, 0])
+        record[0] = record[0] + time.perf_counter() - self.startTime
+        record[1] = record[1] + 1
+        return False
+
+def enable(withCProfile=False):
+    # Enables the timers; the environment variable is set as well so that
+    # worker processes started later profile themselves.
+    global enabled, mode, profiler
+    enabled = True
+    mode = 'cprofile' if withCProfile else (mode if mode == 'cprofile' else '1')
+    os.environ['DR4GM_PROFILE'] = mode
+    if mode == 'cprofile' and profiler is None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+def stage(name):
+    if not enabled:
+        return noStage
+    return stageTimer(name)
+
+def addCount(name, value=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + value
+
+def addBytesRead(chunkId, numOfBytes):
+    if enabled:
+        bytesReadPerChunk[chunkId] = bytesReadPerChunk.get(chunkId, 0) + int(numOfBytes)
+
+def reset():
+    stages.clear()
+    counters.clear()
+    bytesReadPerChunk.clear()
+
+def snapshot():
+    return {'stages': {name: list(record) for name, record in stages.items()},
+            'counters': dict(counters), 'bytesReadPerChunk': dict(bytesReadPerChunk)}
+
+def merge(other):
+    # Adds a snapshot taken in a worker process to this process.
+    for name, (seconds, calls) in other['stages'].items():
+        record = stages.setdefault(name, [0.0, 0])
+        record[0] = record[0] + seconds
+        record[1] = record[1] + calls
+    for name, value in other['counters'].items():
+        counters[name] = counters.get(name, 0) + value
+    for chunkId, numOfBytes in other['bytesReadPerChunk'].items():
+        bytesReadPerChunk[chunkId] = bytesReadPerChunk.get(chunkId, 0) + numOfBytes
+
+def callAndSnapshot(func, *args):
+    # Runs func in a worker process and returns its result together with the
+    # timers it recorded, for merge() in the parent process.
+    reset()
+    result = func(*args)
+    return result, snapshot()
+
+def mergeResults(results):
+    # Merges the snapshots of callAndSnapshot results and yields the results.
+    for result, other in results:
+        merge(other)
+        yield result
+
+def writeSummary(fileNamePrefix='gmProfile'):
+    # Writes <prefix>.json and <prefix>.csv and, in cprofile mode, the
+    # cProfile statistics of this process to <prefix>.prof.
+    if not enabled:
+        return
+    summary = snapshot()
+    summary['totalBytesRead'] = sum(bytesReadPerChunk.values())
+    with open(fileNamePrefix+'.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    with open(fileNamePrefix+'.csv', 'w') as f:
+        f.write('kind,name,seconds,calls,value\n')
+        for name, (seconds, calls) in sorted(stages.items(), key=lambda item: -item[1][0]):
+            f.write('stage,'+name+','+repr(seconds)+','+str(calls)+',\n')
+        for name, value in sorted(counters.items()):
+            f.write('counter,'+name+',,,'+str(value)+'\n')
+        for chunkId, numOfBytes in sorted(bytesReadPerChunk.items()):
+            f.write('bytesRead,'+str(chunkId)+',,,'+str(numOfBytes)+'\n')
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(fileNamePrefix+'.prof')
+
+    print(' Profile (wall time per stage; worker stages are summed over processes):')
+    for name, (seconds, calls) in sorted(stages.items(), key=lambda item: -item[1][0]):
+        print('   '+name.ljust(20)+str(round(seconds, 3)).rjust(10)+' s '+str(calls).rjust(8)+' calls')
+    print('   bytes read'.ljust(23)+str(summary['totalBytesRead']).rjust(10))
+    print(' Profile is written to '+fileNamePrefix+'.json and '+fileNamePrefix+'.csv')
+
+if enabled and mode == 'cprofile':
+    profiler = cProfile.Profile()
+    profiler.enable()
@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+# Warm-resident queries of a dataset for gmServer and its clients. The
+# server process loads the station index and opens the gm<chunkId> readers
+# once, and keeps the metrics of recently queried stations in memory, so a
+# query only pays for the stations it has not seen yet. Requests are plain
+# HTTP GETs on localhost answered with JSON:
+#   /status                                      dataset and cache info
+#   /station?x=X&y=Y                             metrics of the nearest station
+#   /timeseries?x=X&y=Y&kind=vel|acc             its along-strike and
+#                                                fault-normal traces
+#   /map?xMin=..&xMax=..&yMin=..&yMax=..&gridSize=..[&keys=PGA,PGV]
+#                                                metrics on a small grid
+# gmFuncLib reads user_defined_params.py of the dataset, so only the engine
+# imports it; clients can be used from any directory.
+import os, json, time, traceback
+import urllib.request, urllib.parse, urllib.error
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+defaultHost = '127.0.0.1'
+defaultPort = 8765
+
+class gmQueryEngine():
+    # Station index, open chunk readers and an LRU cache of station metrics
+    # of the dataset in the current directory. Stations that are in the
+    # gmMetricsCache_*.npz of earlier gmProcessor runs are read from it.
+    def __init__(self, cacheSize=100000, maxMapSize=10000):
+        from gmFuncLib import parametersForGM, loadStLocIndex, gmMetricsCache
+        self.par = parametersForGM()
+        self.par.streamGM = False
+        self.cwd = os.getcwd()
+        self.stLocIndex = loadStLocIndex()
+        self.diskCache = gmMetricsCache(self.par)
+        self.readers = {}
+        self.cacheSize = cacheSize
+        self.maxMapSize = maxMapSize
+        self.cache = {} # stIdGlobal -> metrics in par.totalGMMetricsKeys order, least recently used first
+        self.numOfHits = 0
+        self.numOfMisses = 0
+        # computing one station imports the metric kernel before the first query
+        if len(self.stLocIndex) > 0:
+            self.calcMetrics(np.zeros(1, dtype=np.int64))
+
+    def getReader(self, chunkId, numOfSt):
+        from gmFuncLib import gmChunkReader
+        if chunkId not in self.readers:
+            self.readers[chunkId] = gmChunkReader(chunkId, numOfSt)
+        return self.readers[chunkId]
+
+    def getStInfo(self, stIdGlobal):
+        row = self.stLocIndex[stIdGlobal]
+        return {'stIdGlobal': int(stIdGlobal), 'x': float(row[0]), 'y': float(row[1]), 'z': float(row[2]),
+                'chunkId': int(row[3]), 'numOfSt': int(row[4]), 'stIdInChunk': int(row[5])}
+
+    def addToCache(self, stIdGlobal, values):
+        self.cache[stIdGlobal] = values
+        while len(self.cache) > self.cacheSize:
+            self.cache.pop(next(iter(self.cache)))
+
+    def calcMetrics(self, stIdGlobal):
+        # Metrics of stations that are not in the LRU cache, from the disk
+        # cache or computed chunk by chunk with the open readers. Returns
+        # {stIdGlobal: values}.
+        from gmFuncLib import groupStationsByChunk, getGMMetricsForOneChunk
+        keys = self.par.totalGMMetricsKeys
+        results = {}
+        for chunkId, (stLocIds, numOfSt, stIdsInChunk) in groupStationsByChunk(stIdGlobal, self.stLocIndex).items():
+            found, cachedValues = self.diskCache.lookup(chunkId, stIdsInChunk)
+            cachedValues = np.column_stack([cachedValues[key] for key in keys])
+            for stId, values in zip(stIdGlobal[stLocIds[found]], cachedValues):
+                results[int(stId)] = values
+            if np.all(found):
+                continue
+            gmMetricsValues = getGMMetricsForOneChunk(chunkId, numOfSt, stIdsInChunk[~found], self.par,
+                                                      reader=self.getReader(chunkId, numOfSt))
+            for stId, values in zip(stIdGlobal[stLocIds[~found]], np.column_stack([gmMetricsValues[key] for key in keys])):
+                results[int(stId)] = values
+        for stId, values in results.items():
+            self.addToCache(stId, values)
+        return results
+
+    def getMetrics(self, stLocs):
+        # Returns the ids of the nearest stations of an (n, 3) array of
+        # points and their (n, len(par.totalGMMetricsKeys)) metrics.
+        stIdGlobal = np.atleast_1d(self.stLocIndex.query(stLocs))
+        uniqueIds, inverse = np.unique(stIdGlobal, return_inverse=True)
+        values = {}
+        for stId in uniqueIds:
+            stId = int(stId)
+            if stId in self.cache:
+                self.cache[stId] = values[stId] = self.cache.pop(stId)
+        self.numOfHits = self.numOfHits + len(values)
+        missing = np.array([stId for stId in uniqueIds if int(stId) not in values], dtype=np.int64)
+        self.numOfMisses = self.numOfMisses + len(missing)
+        if len(missing) > 0:
+            values.update(self.calcMetrics(missing))
+        values = np.array([values[int(stId)] for stId in uniqueIds])
+        return stIdGlobal, values[inverse.ravel()]
+
+    def getStation(self, x, y):
+        stIdGlobal, values = self.getMetrics(np.array([[x, y, 0.]]))
+        result = self.getStInfo(stIdGlobal[0])
+        result['metrics'] = {key: float(value) for key, value in zip(self.par.totalGMMetricsKeys, values[0])}
+        return result
+
+    def getTimeseries(self, x, y, kind='vel'):
+        from gmFuncLib import velToAcc
+        stIdGlobal = np.atleast_1d(self.stLocIndex.query(np.array([[x, y, 0.]])))[0]
+        result = self.getStInfo(stIdGlobal)
+        reader = self.getReader(result['chunkId'], result['numOfSt'])
+        alongStrike, faultNormal = reader.getVel(result['stIdInChunk'])
+        unit = 'm/s'
+        if kind == 'acc':
+            alongStrike, faultNormal = velToAcc(alongStrike, faultNormal, self.par)
+            unit = 'm/s/s'
+        elif kind != 'vel':
+            raise ValueError('kind must be vel or acc')
+        result.update({'kind': kind, 'unit': unit, 'dt': float(self.par.dt),
+                       'alongStrike': alongStrike.tolist(), 'faultNormal': faultNormal.tolist()})
+        return result
+
+    def getMap(self, xMin, xMax, yMin, yMax, gridSize, keys=None):
+        keys = keys or self.par.totalGMMetricsKeys
+        unknownKeys = [key for key in keys if key not in self.par.totalGMMetricsKeys]
+        if len(unknownKeys) > 0:
+            raise ValueError('unknown metrics '+','.join(unknownKeys))
+        if not np.all(np.isfinite([xMin, xMax, yMin, yMax, gridSize])):
+            raise ValueError('map bounds and gridSize must be finite')
+        if gridSize <= 0:
+            raise ValueError('gridSize must be positive')
+        if xMax < xMin or yMax < yMin:
+            raise ValueError('map bounds must satisfy xMin <= xMax and yMin <= yMax')
+        nx = round((xMax-xMin)/gridSize+1)
+        ny = round((yMax-yMin)/gridSize+1)
+        if nx*ny > self.maxMapSize:
+            raise ValueError(str(nx*ny)+' grid points exceed the limit of '+str(self.maxMapSize)+'; use gmProcessor for large maps')
+        xx, yy = np.meshgrid(np.linspace(xMin, xMax, nx), np.linspace(yMin, yMax, ny))
+        stIdGlobal, values = self.getMetrics(np.column_stack((xx.ravel(), yy.ravel(), np.zeros(xx.size))))
+        keyIds = [self.par.totalGMMetricsKeys.index(key) for key in keys]
+        return {'x': xx[0].tolist(), 'y': yy[:,0].tolist(),
+                'values': {key: values[:,keyId].reshape(xx.shape).tolist() for key, keyId in zip(keys, keyIds)}}
+
+    def getStatus(self):
+        return {'cwd': self.cwd, 'pid': os.getpid(), 'numOfSt': len(self.stLocIndex),
+                'chunkIds': sorted(int(chunkId) for chunkId in np.unique(self.stLocIndex[:,3])),
+                'keys': self.par.totalGMMetricsKeys, 'dt': float(self.par.dt),
+                'cachedStations': len(self.cache), 'cacheSize': self.cacheSize,
+                'hits': self.numOfHits, 'misses': self.numOfMisses, 'maxMapSize': self.maxMapSize}
+
+class gmRequestHandler(BaseHTTPRequestHandler):
+    def getFloat(self, query, name):
+        if name not in query:
+            raise ValueError('missing parameter '+name)
+        return float(query[name][0])
+
+    def do_GET(self):
+        startTime = time.perf_counter()
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        engine = self.server.engine
+        try:
+            if url.path == '/status':
+                result = engine.getStatus()
+            elif url.path == '/station':
+                result = engine.getStation(self.getFloat(query, 'x'), self.getFloat(query, 'y'))
+            elif url.path == '/timeseries':
+                result = engine.getTimeseries(self.getFloat(query, 'x'), self.getFloat(query, 'y'),
+                                              query.get('kind', ['vel'])[0])
+            elif url.path == '/map':
+                keys = [key for key in query.get('keys', [''])[0].split(',') if key]
+                result = engine.getMap(*[self.getFloat(query, name) for name in ['xMin', 'xMax', 'yMin', 'yMax', 'gridSize']],
+                                       keys=keys)
+            else:
+                self.sendJson(404, {'error': 'unknown request '+url.path})
+                return
+        except ValueError as e:
+            self.sendJson(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # the server keeps serving; the traceback goes to its log
+            traceback.print_exc()
+            self.sendJson(500, {'error': type(e).__name__+': '+str(e)})
+            return
+        result['seconds'] = time.perf_counter()-startTime
+        self.sendJson(200, result)
+
+    def sendJson(self, code, result):
+        body = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def serve(engine, host=defaultHost, port=defaultPort, verbose=False):
+    # Answers requests one at a time until interrupted.
+    server = HTTPServer((host, port), gmRequestHandler)
+    server.engine = engine
+    server.verbose = verbose
+    print(' Serving '+engine.cwd+' on http://'+host+':'+str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class gmServerClient():
+    # Thin client of gmServer for the GUI and notebooks, e.g.
+    #   client = gmServerClient()
+    #   if client.isServing(os.getcwd()):
+    #       pga = client.getStation(10e3, 5e3)['metrics']['PGA']
+    def __init__(self, host=defaultHost, port=defaultPort, timeout=30.):
+        self.url = 'http://'+host+':'+str(port)
+        self.timeout = timeout
+
+    def get(self, path, timeout=None, **params):
+        url = self.url+path+('?'+urllib.parse.urlencode(params) if params else '')
+        try:
+            with urllib.request.urlopen(url, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise ValueError(json.loads(e.read()).get('error', str(e)))
+
+    def getStatus(self, timeout=None):
+        return self.get('/status', timeout)
+
+    def isServing(self, path=None, timeout=0.5):
+        # True if a server answers and, when path is given, serves that
+        # dataset directory.
+        try:
+            status = self.getStatus(timeout)
+        except (OSError, ValueError):
+            return False
+        return path is None or os.path.realpath(status['cwd']) == os.path.realpath(path)
+
+    def getStation(self, x, y):
+        return self.get('/station', x=x, y=y)
+
+    def getTimeseries(self, x, y, kind='vel'):
+        result = self.get('/timeseries', x=x, y=y, kind=kind)
+        result['alongStrike'] = np.array(result['alongStrike'])
+        result['faultNormal'] = np.array(result['faultNormal'])
+        return result
+
+    def getMap(self, xMin, xMax, yMin, yMax, gridSize, keys=None):
+        params = {'xMin': xMin, 'xMax': xMax, 'yMin': yMin, 'yMax': yMax, 'gridSize': gridSize}
+        if keys:
+            params['keys'] = ','.join(keys)
+        result = self.get('/map', **params)
+        result['x'] = np.array(result['x'])
+        result['y'] = np.array(result['y'])
+        result['values'] = {key: np.array(values) for key, values in result['values'].items()}
+        return result
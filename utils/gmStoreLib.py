@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+# Chunked, compressed, station-major store of the gm<chunkId> files of a run,
+# written by archiveGMData --pack and read by gmFuncLib and genMapFuncLib
+# when the raw gm files are not present. Layout of the store directory:
+#   meta.json                   time steps, dtype, block size and, per chunk,
+#                               numOfSt and the error of the float32 downcast
+#   stLoc.npz                   coordinates of every chunk (stLoc<chunkId>)
+#                               and the unique station index (x, y, z,
+#                               chunkId, numOfSt, stIdInChunk)
+#   gm<chunkId>_<blockId>.npz   velocities of stBlockSize consecutive
+#                               stations as (station, component, time)
+# It also writes the uncompressed station-major sidecar gm<chunkId>.stmajor
+# of gmTranspose, a (numOfSt, 3, numOfTimeStep) float64 copy of gm<chunkId>.
+import os, re, json, time
+import numpy as np
+
+storeDirName = 'gmStore'
+storeVersion = 1
+sidecarSuffix = '.stmajor'
+
+def findChunkIds(fileNamePrefix):
+    # Returns the sorted ids of files named <fileNamePrefix><chunkId> in
+    # the current directory.
+    pattern = re.compile(re.escape(fileNamePrefix)+r'(\d+)$')
+    chunkIds = []
+    for fName in os.listdir('.'):
+        match = pattern.match(fName)
+        if match:
+            chunkIds.append(int(match.group(1)))
+    return sorted(chunkIds)
+
+class gmStore():
+    def __init__(self, path=storeDirName, numOfCachedBlocks=4):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.numOfTimeStep = self.meta['numOfTimeStep']
+        self.stBlockSize = self.meta['stBlockSize']
+        self.chunks = {int(chunk['chunkId']): chunk for chunk in self.meta['chunks']}
+        self.numOfCachedBlocks = numOfCachedBlocks
+        self.blocks = {} # (chunkId, blockId) -> block, least recently used first
+
+    @staticmethod
+    def exists(path=storeDirName):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+
+    @staticmethod
+    def getFingerprint(path=storeDirName):
+        # (-1, size, mtime) of meta.json, in the form of the gm file fingerprints.
+        fileStat = os.stat(os.path.join(path, 'meta.json'))
+        return np.array([[-1, fileStat.st_size, fileStat.st_mtime_ns]], dtype=np.int64)
+
+    def getChunkIds(self):
+        return sorted(self.chunks)
+
+    def getNumOfSt(self, chunkId):
+        return self.chunks[chunkId]['numOfSt']
+
+    def loadStLoc(self, chunkId):
+        with np.load(os.path.join(self.path, 'stLoc.npz')) as stLoc:
+            return stLoc['stLoc'+str(chunkId)]
+
+    def loadStLocIndex(self):
+        with np.load(os.path.join(self.path, 'stLoc.npz')) as stLoc:
+            return stLoc['stLocIndex']
+
+    def loadBlock(self, chunkId, blockId):
+        # Decompressed block as float64 (station, component, time); the last
+        # few blocks are kept, so batches of nearby stations read each once.
+        key = (chunkId, blockId)
+        if key in self.blocks:
+            self.blocks[key] = self.blocks.pop(key)
+            return self.blocks[key]
+        with np.load(os.path.join(self.path, 'gm'+str(chunkId)+'_'+str(blockId)+'.npz')) as block:
+            vel = block['vel'].astype(np.float64)
+        self.blocks[key] = vel
+        while len(self.blocks) > self.numOfCachedBlocks:
+            self.blocks.pop(next(iter(self.blocks)))
+        return vel
+
+    def getStationMajor(self, chunkId, stIds):
+        # Returns (3, numOfTimeStep) for a single station id or
+        # (len(stIds), 3, numOfTimeStep) for a batch, touching only the blocks
+        # that hold the requested stations.
+        if np.ndim(stIds) == 0:
+            return self.loadBlock(chunkId, int(stIds)//self.stBlockSize)[int(stIds)%self.stBlockSize].copy()
+        stIds = np.asarray(stIds, dtype=np.int64)
+        vel = np.empty((len(stIds), 3, self.numOfTimeStep))
+        blockIds = stIds//self.stBlockSize
+        for blockId in np.unique(blockIds):
+            rows = np.nonzero(blockIds == blockId)[0]
+            vel[rows] = self.loadBlock(chunkId, int(blockId))[stIds[rows]%self.stBlockSize]
+        return vel
+
+    def getTimeSlices(self, chunkId, timeStepIds, compId):
+        # (len(timeStepIds), numOfSt) values of one component at the given
+        # time steps, reading every block of the chunk once.
+        numOfSt = self.getNumOfSt(chunkId)
+        values = np.empty((len(timeStepIds), numOfSt))
+        for blockId, start in enumerate(range(0, numOfSt, self.stBlockSize)):
+            block = self.loadBlock(chunkId, blockId)
+            values[:, start:start+block.shape[0]] = block[:, compId, timeStepIds].T
+        return values
+
+def iterStationBlocks(data, stBlockSize):
+    # Yields (start, block) for consecutive blocks of stations of a
+    # time-major (numOfTimeStep, numOfSt, 3) array, each block transposed to
+    # (station, component, time). Only one block is held in memory.
+    for start in range(0, data.shape[1], stBlockSize):
+        yield start, np.ascontiguousarray(np.transpose(data[:, start:start+stBlockSize, :], (1, 2, 0)))
+
+def getSidecarFileName(fileName):
+    return fileName+sidecarSuffix
+
+def isSidecarValid(fileName, numOfSt, valueSize=8):
+    # A sidecar is used if it holds a whole number of station-major traces
+    # and, when gm<chunkId> is still present, it matches its size and is
+    # not older than it.
+    sidecarFileName = getSidecarFileName(fileName)
+    if not os.path.isfile(sidecarFileName):
+        return False
+    sidecarStat = os.stat(sidecarFileName)
+    if sidecarStat.st_size == 0 or sidecarStat.st_size % (numOfSt*3*valueSize) != 0:
+        return False
+    if os.path.isfile(fileName):
+        fileStat = os.stat(fileName)
+        return fileStat.st_size == sidecarStat.st_size and fileStat.st_mtime_ns <= sidecarStat.st_mtime_ns
+    return True
+
+def writeSidecar(fileName, numOfSt, stBlockSize=1024):
+    # Transposes the time-major gm file out-of-core into its station-major
+    # sidecar, one block of stations at a time. The sidecar is written to a
+    # temporary file and renamed, so readers never see a partial one.
+    numOfTimeStep = os.path.getsize(fileName)//8//(numOfSt*3)
+    data = np.memmap(fileName, dtype=np.float64, mode='r', shape=(numOfTimeStep, numOfSt, 3))
+    tmpFileName = getSidecarFileName(fileName)+'.tmp'
+    sidecar = np.memmap(tmpFileName, dtype=np.float64, mode='w+', shape=(numOfSt, 3, numOfTimeStep))
+    for start, vel in iterStationBlocks(data, stBlockSize):
+        sidecar[start:start+vel.shape[0]] = vel
+    sidecar.flush()
+    del sidecar, data
+    os.replace(tmpFileName, getSidecarFileName(fileName))
+    return numOfTimeStep
+
+def packGMStore(chunkIds, stLocIndex, loadStLoc, path=storeDirName, useFloat32=False, stBlockSize=256):
+    # Converts the time-major gm<chunkId> files of the current directory to
+    # a store in path. loadStLoc(chunkId) returns the coordinates of one
+    # chunk and stLocIndex is the unique station index of the run. Each
+    # block is read as one strided slab of the memory-mapped file, so memory
+    # is bounded by stBlockSize*3*numOfTimeStep values.
+    os.makedirs(path, exist_ok=True)
+    for fName in os.listdir(path):
+        if fName == 'meta.json' or fName == 'stLoc.npz' or (fName.startswith('gm') and fName.endswith('.npz')):
+            os.remove(os.path.join(path, fName))
+    stLocs = {'stLocIndex': stLocIndex}
+    chunks = []
+    numOfTimeStep = None
+    startTime = time.time()
+    rawBytes = 0
+    for chunkId in chunkIds:
+        stLoc = loadStLoc(chunkId)
+        numOfSt = stLoc.shape[0]
+        stLocs['stLoc'+str(chunkId)] = stLoc
+        fileName = 'gm'+str(chunkId)
+        numOfTimeStepOfChunk = os.path.getsize(fileName)//8//(numOfSt*3)
+        if numOfTimeStep is None:
+            numOfTimeStep = numOfTimeStepOfChunk
+        elif numOfTimeStep != numOfTimeStepOfChunk:
+            raise ValueError(fileName+' has '+str(numOfTimeStepOfChunk)+' time steps instead of '+str(numOfTimeStep))
+        data = np.memmap(fileName, dtype=np.float64, mode='r', shape=(numOfTimeStep, numOfSt, 3))
+
+        maxAbsError = 0.
+        maxAbsValue = 0.
+        for blockId, (start, vel) in enumerate(iterStationBlocks(data, stBlockSize)):
+            maxAbsValue = max(maxAbsValue, float(np.max(np.abs(vel), initial=0.)))
+            if useFloat32:
+                vel32 = vel.astype(np.float32)
+                maxAbsError = max(maxAbsError, float(np.max(np.abs(vel32.astype(np.float64)-vel), initial=0.)))
+                vel = vel32
+            np.savez_compressed(os.path.join(path, fileName+'_'+str(blockId)+'.npz'), vel=vel)
+        rawBytes = rawBytes + numOfTimeStep*numOfSt*3*8
+        chunks.append({'chunkId': int(chunkId), 'numOfSt': int(numOfSt),
+                       'maxAbsValue': maxAbsValue, 'maxAbsError': maxAbsError})
+        del data
+        print(' '+fileName+' is packed into '+str(blockId+1)+' blocks.')
+
+    np.savez(os.path.join(path, 'stLoc.npz'), **stLocs)
+    meta = {'version': storeVersion, 'layout': 'station,component,time',
+            'dtype': 'float32' if useFloat32 else 'float64', 'numOfTimeStep': int(numOfTimeStep or 0),
+            'stBlockSize': int(stBlockSize), 'chunks': chunks}
+    # meta.json is written last, so an interrupted pack is not mistaken for a store
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    packedBytes = sum(os.path.getsize(os.path.join(path, fName)) for fName in os.listdir(path))
+    print(' '+str(round(rawBytes/2**20, 1))+' MB of gm data are packed into '+str(round(packedBytes/2**20, 1))
+          +' MB in '+path+' in '+str(round(time.time()-startTime, 1))+' s.')
+    return meta
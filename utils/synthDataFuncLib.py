@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+# Synthetic datasets in the EQdyna output format (gm<N>, surface_coor.txt<N>,
+# src_evol<N>, frt.txt<N> and user_defined_params.py) for benchmarks.
+import os
+import numpy as np
+
+class parametersForSyntheticData():
+    # all lengths are in meters and times in seconds
+    xMin = -10e3
+    xMax = 10e3
+    yMin = -5e3
+    yMax = 5e3
+    dx = 100.
+    dy = 100.
+    dz = 100.
+    numOfChunks = 4
+    dt = 0.008 # solver time step; gm and src_evol are written every gmSamplingRate steps
+    gmSamplingRate = 10
+    term = 8.0
+    faultXmin = -5e3
+    faultXmax = 5e3
+    faultDepth = 5e3
+    rupVel = 2.8e3
+    waveVel = 3.2e3
+    pulseFreq = 1.0 # Hz
+    noiseLevel = 0.01
+    timeBlockSize = 64
+    seed = 0
+    writeFault = True
+
+def getNumOfTimeStep(par):
+    return int(round(par.term/(par.dt*par.gmSamplingRate)))+1
+
+def splitColumnsIntoChunks(numOfColumns, numOfChunks):
+    # Column ranges of each chunk; neighbouring chunks share their boundary
+    # column, as EQdyna partitions do, so the station index sees duplicates.
+    edges = np.linspace(0, numOfColumns-1, numOfChunks+1).round().astype(int)
+    return [(edges[i], edges[i+1]+1) for i in range(numOfChunks) if edges[i+1] > edges[i]]
+
+def ricker(t, freq):
+    a = (np.pi*freq*t)**2
+    return (1.-2.*a)*np.exp(-a)
+
+def writeUserDefinedParams(par, path='.'):
+    with open(os.path.join(path, 'user_defined_params.py'), 'w') as f:
+        f.write('class par:\n')
+        f.write('    dt = '+repr(float(par.dt))+'\n')
+        f.write('    term = '+repr(float(par.term))+'\n')
+        f.write('    dx = '+repr(float(par.dx))+'\n')
+        f.write('    dy = '+repr(float(par.dy))+'\n')
+        f.write('    dz = '+repr(float(par.dz))+'\n')
+
+def writeChunk(dataFileName, stLoc, numOfTimeStep, nValue, valuesAt, par):
+    # Writes one time-major (numOfTimeStep, numOfSt, nValue) float64 file in
+    # blocks of time steps, so memory stays bounded for large chunks.
+    data = np.memmap(dataFileName, dtype=np.float64, mode='w+', shape=(numOfTimeStep, stLoc.shape[0], nValue))
+    dtGM = par.dt*par.gmSamplingRate
+    for start in range(0, numOfTimeStep, par.timeBlockSize):
+        t = np.arange(start, min(start+par.timeBlockSize, numOfTimeStep))*dtGM
+        data[start:start+len(t)] = valuesAt(t)
+    data.flush()
+    del data
+
+def writeSurfaceChunks(par, path='.'):
+    # Velocities of a pulse radiated by a bilateral rupture on the fault
+    # trace y=0, faultXmin<=x<=faultXmax, decaying with distance.
+    rng = np.random.default_rng(par.seed)
+    xArr = np.arange(par.xMin, par.xMax+par.dx/2, par.dx)
+    yArr = np.arange(par.yMin, par.yMax+par.dy/2, par.dy)
+    numOfTimeStep = getNumOfTimeStep(par)
+    numOfStTotal = 0
+    for chunkId, (i0, i1) in enumerate(splitColumnsIntoChunks(len(xArr), par.numOfChunks)):
+        xx, yy = np.meshgrid(xArr[i0:i1], yArr)
+        stLoc = np.column_stack((xx.ravel(), yy.ravel(), np.zeros(xx.size)))
+        np.savetxt(os.path.join(path, 'surface_coor.txt'+str(chunkId)), stLoc)
+
+        xOnFault = np.clip(stLoc[:,0], par.faultXmin, par.faultXmax)
+        r = np.hypot(stLoc[:,0]-xOnFault, stLoc[:,1])
+        arrival = np.abs(xOnFault)/par.rupVel + r/par.waveVel + 1./par.pulseFreq
+        amp = 1./(1.+r/1e3)
+        side = np.where(stLoc[:,1] >= 0, 1., -1.)
+        noise = par.noiseLevel*rng.standard_normal((3, stLoc.shape[0]))
+
+        def valuesAt(t):
+            pulse = ricker(t[:,None]-arrival[None,:], par.pulseFreq)
+            values = np.empty((len(t), stLoc.shape[0], 3))
+            values[...,0] = amp*side*pulse + noise[0]*pulse
+            values[...,1] = 0.6*amp*ricker(t[:,None]-arrival[None,:]-0.25/par.pulseFreq, par.pulseFreq) + noise[1]*pulse
+            values[...,2] = 0.3*amp*pulse + noise[2]*pulse
+            return values
+
+        writeChunk(os.path.join(path, 'gm'+str(chunkId)), stLoc, numOfTimeStep, 3, valuesAt, par)
+        numOfStTotal = numOfStTotal + stLoc.shape[0]
+    return numOfStTotal
+
+def writeFaultChunks(par, path='.'):
+    # Slip rates of a rupture spreading from the centre of the fault plane.
+    xArr = np.arange(par.faultXmin, par.faultXmax+par.dx/2, par.dx)
+    zArr = np.arange(-par.faultDepth, par.dz/2, par.dz)
+    numOfTimeStep = getNumOfTimeStep(par)
+    riseTime = 1./par.pulseFreq
+    numOfStTotal = 0
+    for chunkId, (i0, i1) in enumerate(splitColumnsIntoChunks(len(xArr), par.numOfChunks)):
+        xx, zz = np.meshgrid(xArr[i0:i1], zArr)
+        stLoc = np.column_stack((xx.ravel(), np.zeros(xx.size), zz.ravel()))
+        np.savetxt(os.path.join(path, 'frt.txt'+str(chunkId)), stLoc)
+        ruptureTime = np.hypot(stLoc[:,0], stLoc[:,2]+par.faultDepth/2)/par.rupVel
+
+        def valuesAt(t):
+            tau = (t[:,None]-ruptureTime[None,:])/riseTime
+            return np.where((tau > 0) & (tau < 1), 2.*(1.-tau), 0.)[...,None]
+
+        writeChunk(os.path.join(path, 'src_evol'+str(chunkId)), stLoc, numOfTimeStep, 1, valuesAt, par)
+        numOfStTotal = numOfStTotal + stLoc.shape[0]
+    return numOfStTotal
+
+def genSyntheticDataset(par, path='.'):
+    # Writes a complete dataset to path and returns a summary of its size.
+    os.makedirs(path, exist_ok=True)
+    writeUserDefinedParams(par, path)
+    numOfSt = writeSurfaceChunks(par, path)
+    numOfFaultSt = writeFaultChunks(par, path) if par.writeFault else 0
+    numOfTimeStep = getNumOfTimeStep(par)
+    return {'numOfChunks': par.numOfChunks, 'numOfSt': numOfSt, 'numOfFaultSt': numOfFaultSt,
+            'numOfTimeStep': numOfTimeStep, 'dtGM': par.dt*par.gmSamplingRate,
+            'gmBytes': numOfSt*numOfTimeStep*3*8}